@@ -0,0 +1,213 @@
+import argparse
+import contextlib
+import itertools
+import json
+import os
+import platform
+import sys
+import time
+
+import numpy as np
+import convolution
+from engine import Engine, apply_rule, kernel_builders, storages, view
+from runner import to_frame
+
+# Headless timings of the step pipeline, phase by phase, over a matrix of
+# grid sizes, kernels and dtypes. Everything starts from fixed seeds, so two
+# runs on the same machine time the same work.
+#
+#   python benchmark.py --sizes 256,1024 -o before.json
+#   python benchmark.py --sizes 256,1024 -o after.json
+#   python benchmark.py --compare before.json after.json
+#
+# The GUI phases need glumpy and are skipped without it. --compare flags
+# every phase whose median got slower by more than --threshold, and exits
+# with status 1 if there is one.
+
+view_modes = {"cells": 0, "fourier": 1, "derivative": 2, "filtered": 3}
+
+def parse_kernel(text):
+    # "name" or "name:size"
+    name, _, size = text.partition(":")
+    if name not in kernel_builders:
+        raise ValueError("unknown kernel %s" % name)
+    return name, int(size) if size else None
+
+def measure(function, min_time=0.2, min_repeats=3, max_repeats=1000):
+    # Runs function until it took min_time in total, at least min_repeats
+    # times, and returns each run's seconds
+    times = []
+    start = time.perf_counter()
+    while len(times) < min_repeats or (time.perf_counter() - start < min_time and len(times) < max_repeats):
+        begin = time.perf_counter()
+        function()
+        times.append(time.perf_counter() - begin)
+    return times
+
+def summary(times):
+    times = np.array(times) * 1000
+    return {"repeats": len(times), "median_ms": float(np.median(times)), "min_ms": float(times.min()),
+            "mean_ms": float(times.mean()), "p90_ms": float(np.percentile(times, 90))}
+
+def engine_phases(engine):
+    # The phases of Engine.step_grid one at a time, on the state the engine
+    # is in, plus the whole step and the view modes
+    kernel = engine.kernels[engine.rule_kernel]
+    cells = engine.simulation_cells
+    old = cells if cells.dtype == bool else cells > 0.5
+    stage = engine.convolution
+    workspace = engine.workspace
+    density = np.empty((engine.width, engine.height), engine.dtype)
+    new_cells = np.empty(density.shape, bool)
+
+    def convolve():
+        stage.reset(cells)
+        stage.convolve(engine.rule_kernel)
+
+    def rule():
+        np.divide(stage.convolve(engine.rule_kernel), float(np.sum(kernel.values)), out=density)
+        np.copyto(new_cells, apply_rule(density, cells, engine.values, workspace))
+
+    def metrics():
+        np.not_equal(new_cells, old, out=engine.derivative)
+        engine.record_metrics(np.count_nonzero(engine.derivative), engine.metrics_due())
+
+    def analyse():
+        # A kernel nobody analysed before, as after an edit
+        convolution.analysis_cache.clear()
+        kernel.touch()
+        kernel.update_fft()
+
+    convolve()
+    rule()
+    phases = {"convolution": convolve, "rule": rule, "metrics": metrics, "kernel analysis": analyse}
+    for name, mode in view_modes.items():
+        def show(mode=mode):
+            # The filtered view is cached per step
+            engine.filtered_step = None
+            return view(engine, mode)
+        phases["view " + name] = show
+    frame = np.empty(density.shape, np.float32)
+    phases["frame"] = lambda: to_frame(view(engine, 0), frame)
+    return phases
+
+def gui_phases(engine, width):
+    # Rasterising the GUI strip, all of it and only what a step redraws.
+    # None without glumpy.
+    try:
+        import gui
+        from simulation import add_graphs
+    except ImportError:
+        return None
+    with contextlib.redirect_stdout(sys.stderr):
+        strip = gui.GUI(max(width, 512), 100)
+    add_graphs(strip, engine, engine.win_limits)
+    painter = gui.KernelPainter(0, 0, engine.kernels[engine.rule_kernel])
+    history = engine.metrics["derivative_metric"]
+
+    def full():
+        for o in strip.objects:
+            o.dirty = True
+        strip.on_draw(0)
+
+    def graphs():
+        history.append(history.latest)
+        strip.on_draw(0)
+
+    def paint():
+        painter.on_mouse(painter.x + painter.width//2, painter.y + painter.height//2, 2)
+        painter.kernel.update_fft()
+
+    return {"gui full": full, "gui graphs": graphs, "kernel paint": paint}
+
+def run_case(size, kernel, dtype, storage, options):
+    name, kernel_size = kernel
+    shape = (size, size)
+    build = kernel_builders[name]
+    kernels = {name: build(shape) if kernel_size is None else build(shape, size=kernel_size)}
+    engine = Engine(size, size, kernels=kernels, rule_kernel=name, seed=options.seed, dtype=dtype, storage=storage)
+    # Autotunes the convolution and gets past the random start
+    engine.step(options.warmup)
+    results = {}
+    timing = {"min_time": options.min_time, "min_repeats": options.repeats}
+    for phase, function in engine_phases(engine).items():
+        results[phase] = summary(measure(function, **timing))
+    results["step"] = summary(measure(engine.step, **timing))
+    if not options.no_gui:
+        for phase, function in (gui_phases(engine, size) or {}).items():
+            results[phase] = summary(measure(function, **timing))
+    return results
+
+def case_key(row):
+    return row["size"], row["kernel"], row["dtype"], row["storage"], row["phase"]
+
+def compare(before, after, threshold=0.1, min_ms=0.05):
+    # Rows of both files by case and phase, with the ratio of their medians.
+    # Returns the rows and the regressions among them.
+    old = {case_key(row): row for row in before["results"]}
+    rows = []
+    regressions = []
+    for row in after["results"]:
+        base = old.get(case_key(row))
+        if base is None:
+            continue
+        ratio = row["median_ms"] / base["median_ms"] if base["median_ms"] else np.inf
+        slower = ratio > 1 + threshold and row["median_ms"] - base["median_ms"] > min_ms
+        rows.append((case_key(row), base["median_ms"], row["median_ms"], ratio, slower))
+        if slower:
+            regressions.append(rows[-1])
+    return rows, regressions
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Time the phases of a simulation step")
+    parser.add_argument("--sizes", default="256,1024,4096,8192", help="comma separated grid sizes")
+    parser.add_argument("--kernels", default="checkerboard:16,circle:33,gaussian:65",
+                        help="comma separated name or name:size, from: " + ", ".join(kernel_builders))
+    parser.add_argument("--dtypes", default="float64,float32")
+    parser.add_argument("--storages", default="bool", help="comma separated, from: " + ", ".join(storages))
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--warmup", type=int, default=5, help="steps before timing")
+    parser.add_argument("--repeats", type=int, default=3, help="minimum runs per phase")
+    parser.add_argument("--min-time", type=float, default=0.2, help="minimum seconds per phase")
+    parser.add_argument("--no-gui", action="store_true", help="skip the GUI phases")
+    parser.add_argument("--compare", nargs=2, metavar=("BEFORE", "AFTER"), help="compare two result files")
+    parser.add_argument("--threshold", type=float, default=0.1, help="relative slowdown counted as a regression")
+    parser.add_argument("-o", "--out", default="-")
+    args = parser.parse_args(argv)
+
+    if args.compare:
+        with open(args.compare[0]) as file:
+            before = json.load(file)
+        with open(args.compare[1]) as file:
+            after = json.load(file)
+        rows, regressions = compare(before, after, args.threshold)
+        for key, old, new, ratio, slower in rows:
+            print("%-60s %10.3f %10.3f %6.2fx%s" % (" ".join(map(str, key)), old, new, ratio, "  SLOWER" if slower else ""))
+        print("%d of %d phases slower by more than %d%%" % (len(regressions), len(rows), 100*args.threshold))
+        return 1 if regressions else 0
+
+    try:
+        kernels = [parse_kernel(text) for text in args.kernels.split(",")]
+    except ValueError as error:
+        parser.error(str(error))
+    sizes = [int(size) for size in args.sizes.split(",")]
+    result = {
+        "meta": {"python": platform.python_version(), "numpy": np.__version__, "machine": platform.machine(),
+                 "processor": platform.processor(), "cpus": os.cpu_count(), "args": vars(args)},
+        "results": [],
+    }
+    for size, kernel, dtype, storage in itertools.product(sizes, kernels, args.dtypes.split(","), args.storages.split(",")):
+        label = kernel[0] if kernel[1] is None else "%s:%d" % kernel
+        print("%d %s %s %s" % (size, label, dtype, storage), file=sys.stderr)
+        for phase, timings in run_case(size, kernel, dtype, storage, args).items():
+            result["results"].append(dict(size=size, kernel=label, dtype=dtype, storage=storage, phase=phase, **timings))
+            print("  %-18s %10.3f ms" % (phase, timings["median_ms"]), file=sys.stderr)
+
+    out = sys.stdout if args.out == "-" else open(args.out, "w")
+    json.dump(result, out, indent=1)
+    if out is not sys.stdout:
+        out.close()
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
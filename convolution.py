@@ -0,0 +1,430 @@
+import hashlib
+import time
+from collections import OrderedDict
+
+import numpy as np
+from scipy import ndimage
+from workspace import Workspace
+
+# Toroidal convolution of the cells with the simulation kernels.
+#
+# Every kernel is centred the same way: output[x] = sum_k K[k]*cells[x+o-k]
+# with o = -(-size//2+1), wrapping around the grid edges. Which method
+# computes it (fft, box, separable or direct) is picked per kernel, grid
+# shape and dtype by timing the candidates on first use.
+
+# Kernels needing more boxes than this go through the FFT
+max_boxes = 16
+# Relative size of the second singular value below which a kernel counts as
+# separable
+separable_tolerance = 1e-9
+# Candidates estimated to be this many times slower than the cheapest one
+# are not worth timing
+autotune_margin = 4
+autotune = True
+# What a kernel needs for a backend besides its values
+backend_needs = {"box": "boxes", "separable": "factors"}
+# Backends that add up the same products in the same order for a cell
+# wherever the grid around it starts, so convolving a tile with its halo
+# gives bit for bit what the full grid does there (see sparse.py)
+exact_backends = ("box", "separable", "direct")
+# Kernel analyses (decompositions, tuned backends, spectra) by a hash of the
+# values and the grid shape, least recently used first. Switching back to a
+# kernel, or undoing an edit, finds its spectrum here. The spectra are grid
+# sized, so the cache is bounded by their bytes.
+analysis_cache = OrderedDict()
+analysis_cache_bytes = 256 << 20
+
+class Kernel:
+    def __init__(self, values, cells_shape, fft=None):
+        self.shape = values.shape
+        self.size = values.shape[0]
+        self.values = values
+
+        self.cells_shape = cells_shape
+        if fft is not None:
+            # A spectrum kept from before (see snapshot.py), in any complex
+            # dtype, spares the transform
+            key = kernel_key(values, cells_shape)
+            if key not in analysis_cache:
+                analysis_cache[key] = analyse_kernel(values, cells_shape, fft)
+        self.update_fft()
+
+    def update_fft(self):
+        key = kernel_key(self.values, self.cells_shape)
+        if key in analysis_cache:
+            analysis_cache.move_to_end(key)
+        else:
+            analysis_cache[key] = analyse_kernel(self.values, self.cells_shape)
+            trim_cache()
+        previous = getattr(self, "backends", {})
+        # key tells analyses apart, e.g. for rules depending on the kernel.
+        # backends is the fastest backend per (grid shape, dtype), see
+        # ConvolutionStage, spectra the spectrum per complex dtype, see
+        # spectrum().
+        self.key = key
+        self.boxes, self.factors, self.backends, self.spectra = analysis_cache[key]
+        # An edited kernel keeps the backends tuned before the edit while it
+        # still fits them, retiming after every brush stroke would stutter
+        for shape, backend in previous.items():
+            needs = backend_needs.get(backend)
+            if needs is None or getattr(self, needs) is not None:
+                self.backends.setdefault(shape, backend)
+        self.stale = False
+
+    def touch(self):
+        # Marks the values as edited in place. The analysis is redone when
+        # the kernel is next convolved with, so a burst of edits between two
+        # steps costs one update.
+        self.stale = True
+
+    def spectrum(self, dtype):
+        # The spectrum in the complex type of the cells' spectrum. Only
+        # kernels convolved through the FFT need one, so it is transformed
+        # on first use and kept in that type alone.
+        dtype = np.dtype(dtype)
+        if dtype not in self.spectra:
+            if self.spectra:
+                fft = next(iter(self.spectra.values()))
+            else:
+                fft = kernel_spectrum(self.values, self.cells_shape)
+            self.spectra[dtype] = fft.astype(dtype, copy=False)
+            trim_cache()
+        return self.spectra[dtype]
+
+    def candidates(self, cells_shape):
+        # Backends able to convolve with this kernel, with a rough per cell
+        # cost used to skip hopeless ones before timing
+        candidates = {"fft": 8*np.log2(cells_shape[-1]*cells_shape[-2])}
+        if max(self.shape) > min(cells_shape[-2:]):
+            # rfft2 crops kernels larger than the grid, keep that behaviour
+            return candidates
+        candidates["direct"] = self.values.size
+        if self.factors is not None:
+            candidates["separable"] = 2*self.size
+        if self.boxes is not None:
+            candidates["box"] = 6 + 5*len(self.boxes)
+        return candidates
+
+    def exact_backend(self, cells_shape):
+        # The cheapest of the exact backends, or "fft" for a kernel larger
+        # than the grid
+        candidates = self.candidates(cells_shape)
+        exact = [backend for backend in exact_backends if backend in candidates]
+        return min(exact, key=candidates.get) if exact else "fft"
+
+
+def kernel_key(values, cells_shape):
+    digest = hashlib.blake2b(np.ascontiguousarray(values).tobytes(), digest_size=16)
+    digest.update(repr((values.shape, values.dtype.str, tuple(cells_shape))).encode())
+    return digest.digest()
+
+def kernel_spectrum(values, cells_shape):
+    # The roll that centres the kernel on each cell is folded into the
+    # spectrum as a phase shift, so convolving needs no np.roll copies
+    shift = -values.shape[0]//2+1
+    freq_x = np.fft.fftfreq(cells_shape[0])[:, None]
+    freq_y = np.fft.rfftfreq(cells_shape[1])[None, :]
+    fft = np.fft.rfft2(values, cells_shape)
+    fft *= np.exp(-2j*np.pi*shift*(freq_x + freq_y))
+    return fft
+
+def analyse_kernel(values, cells_shape, fft=None):
+    spectra = {} if fft is None else {fft.dtype: fft}
+    return box_decomposition(values), separable_factors(values), {}, spectra
+
+def cached_bytes():
+    return sum(spectrum.nbytes for entry in analysis_cache.values() for spectrum in entry[3].values())
+
+def trim_cache():
+    while len(analysis_cache) > 1 and cached_bytes() > analysis_cache_bytes:
+        analysis_cache.popitem(last=False)
+
+def kernel_radius(kernel):
+    # How far from a cell the kernel reaches, in either direction
+    offset = -(-kernel.size//2+1)
+    return max(offset, kernel.size-1-offset)
+
+def box_decomposition(values, tolerance=1e-9):
+    # Splits a piecewise constant kernel into axis aligned boxes
+    # (x0, x1, y0, y1, value), or returns None if it is not one
+    scale = np.abs(values).max()
+    if scale == 0:
+        return []
+    levels = np.round(values / (scale*tolerance)) * (scale*tolerance)
+    covered = levels == 0
+    boxes = []
+    for x0, y0 in zip(*np.nonzero(~covered)):
+        if covered[x0, y0]:
+            continue
+        level = levels[x0, y0]
+        y1 = y0 + 1
+        while y1 < values.shape[1] and levels[x0, y1] == level and not covered[x0, y1]:
+            y1 += 1
+        x1 = x0 + 1
+        while x1 < values.shape[0] and np.all(levels[x1, y0:y1] == level) and not covered[x1, y0:y1].any():
+            x1 += 1
+        covered[x0:x1, y0:y1] = True
+        boxes.append((x0, x1, y0, y1, values[x0:x1, y0:y1].mean()))
+        if len(boxes) > max_boxes:
+            return None
+    return boxes
+
+def separable_factors(values):
+    # Returns (column, row) with values == outer(column, row), or None
+    u, s, vt = np.linalg.svd(values)
+    if s[0] == 0 or (len(s) > 1 and s[1] > separable_tolerance*s[0]):
+        return None
+    return u[:, 0]*np.sqrt(s[0]), vt[0]*np.sqrt(s[0])
+
+def wrap_pad(cells, pad, out):
+    # np.pad(cells, pad, mode="wrap") over the last two axes, written into
+    # out, for pad no larger than the grid
+    width, height = cells.shape[-2:]
+    out[..., pad:pad+width, pad:pad+height] = cells
+    out[..., :pad, pad:pad+height] = cells[..., width-pad:, :]
+    out[..., pad+width:, pad:pad+height] = cells[..., :pad, :]
+    out[..., :, :pad] = out[..., :, height:height+pad]
+    out[..., :, pad+height:] = out[..., :, pad:2*pad]
+    return out
+
+def summed_area_table(cells, pad, out=None):
+    # Prefix sums over the last two axes of the cells, padded by wrapping
+    # so that boxes reaching over an edge need no special case. Integer
+    # cells are summed exactly in int32.
+    dtype = np.int32 if cells.dtype.kind in "biu" else np.dtype(float)
+    width, height = cells.shape[-2:]
+    if out is None:
+        out = np.empty(cells.shape[:-2] + (width+2*pad+1, height+2*pad+1), dtype)
+    out[..., 0, :] = 0
+    out[..., :, 0] = 0
+    # Padding straight into the table and summing in place, a casting
+    # cumsum would allocate a full-grid temporary
+    wrap_pad(cells, pad, out[..., 1:, 1:])
+    np.cumsum(out[..., 1:, 1:], axis=-1, out=out[..., 1:, 1:])
+    # Accumulating down the rows one row at a time keeps the memory access
+    # contiguous, a strided cumsum along axis -2 is several times slower
+    for i in range(2, out.shape[-2]):
+        np.add(out[..., i-1, :], out[..., i, :], out=out[..., i, :])
+    return out
+
+def box_conv2d(table, pad, kernel, shape, dtype=float, out=None, scratch=None, sums=None):
+    # O(1) per cell and box, whatever the size of the boxes. Each box's sum
+    # of cells is taken from its four corners in the table's dtype, which is
+    # exact, and only then weighted, so the result does not depend on where
+    # the table starts.
+    width, height = shape
+    offset = -(-kernel.size//2+1) + pad + 1
+    if out is None:
+        out = np.empty(table.shape[:-2] + (width, height), dtype)
+    if sums is None:
+        sums = np.empty(out.shape, table.dtype)
+    def corner(x, y):
+        return table[..., offset-x:offset-x+width, offset-y:offset-y+height]
+    if not kernel.boxes:
+        out.fill(0)
+    for i, (x0, x1, y0, y1, value) in enumerate(kernel.boxes):
+        np.subtract(corner(x0, y0), corner(x0, y1), out=sums)
+        np.subtract(sums, corner(x1, y0), out=sums)
+        np.add(sums, corner(x1, y1), out=sums)
+        term = sums
+        if value != 1:
+            if scratch is None:
+                scratch = np.empty(out.shape, dtype)
+            term = np.multiply(sums, value, out=scratch)
+        if i == 0:
+            np.copyto(out, term)
+        else:
+            np.add(out, term, out=out)
+    return out
+
+
+def separable_conv2d(cells, kernel, dtype=float, out=None, scratch=None):
+    column, row = kernel.factors
+    if scratch is None:
+        scratch = np.empty(cells.shape, dtype)
+    ndimage.correlate1d(cells, column[::-1], axis=-2, output=scratch, mode="grid-wrap")
+    if out is None:
+        out = np.empty(cells.shape, dtype)
+    ndimage.correlate1d(scratch, row[::-1], axis=-1, output=out, mode="grid-wrap")
+    return out
+
+def direct_conv2d(cells, kernel, dtype=float, out=None):
+    # Correlating with the flipped kernel at origin 0 gives the same centring
+    # as the FFT path for odd and even kernel sizes
+    weights = kernel.values[::-1, ::-1].reshape((1,)*(cells.ndim-2) + kernel.shape)
+    if out is None:
+        out = np.empty(cells.shape, dtype)
+    ndimage.correlate(cells, weights, output=out, mode="grid-wrap")
+    return out
+
+
+class ConvolutionStage:
+    # Convolutions of the cells a step starts from. The forward transforms
+    # (spectrum or summed-area table) are shared between kernels, and both
+    # they and each kernel's output are only computed when asked for. All of
+    # them live in workspace buffers, so they stay valid until the next step.
+    #
+    # exact restricts the backends to exact_backends and picks among them by
+    # their estimated cost instead of timing, for engines that recompute
+    # tiles of the grid on their own (sparse.py).
+    def __init__(self, kernels, shape, dtype=float, workspace=None, exact=False):
+        self.kernels = kernels
+        self.shape = shape
+        self.dtype = np.dtype(dtype)
+        self.exact = exact
+        self.complex_dtype = np.result_type(self.dtype, np.complex64)
+        self.workspace = workspace if workspace is not None else Workspace()
+        self.reset(None)
+
+    def reset(self, cells):
+        self.cells = cells
+        self.cells_fft = None
+        self.cells_table = None
+        self.table_pad = 0
+        self.convolved = {}
+
+    def convolve(self, name):
+        if name not in self.convolved:
+            kernel = self.kernels[name]
+            if kernel.stale:
+                kernel.update_fft()
+            out = self.workspace.get("conv " + name, self.cells.shape, self.dtype)
+            backend = self.backend(kernel, out)
+            self.convolved[name] = getattr(self, backend + "_convolve")(kernel, out)
+        return self.convolved[name]
+
+    def backend(self, kernel, out):
+        if self.exact:
+            return kernel.exact_backend(self.cells.shape)
+        key = (self.cells.shape, self.cells.dtype, self.dtype)
+        if key not in kernel.backends:
+            kernel.backends[key] = self.fastest(kernel, out)
+        return kernel.backends[key]
+
+    def fastest(self, kernel, out):
+        candidates = kernel.candidates(self.cells.shape)
+        if not autotune:
+            return "box" if "box" in candidates else "fft"
+        cheapest = min(candidates.values())
+        candidates = [backend for backend, cost in candidates.items() if cost <= autotune_margin*cheapest]
+        if len(candidates) == 1:
+            return candidates[0]
+        timings = {}
+        spectrum_kept = self.complex_dtype in kernel.spectra
+        for backend in candidates:
+            # Time from scratch, including the shared transform the backend
+            # would need, and keep the best of two runs
+            best = np.inf
+            for _ in range(2):
+                self.cells_fft = None
+                self.cells_table = None
+                start = time.perf_counter()
+                getattr(self, backend + "_convolve")(kernel, out)
+                best = min(best, time.perf_counter() - start)
+            timings[backend] = best
+        self.cells_fft = None
+        self.cells_table = None
+        fastest = min(timings, key=timings.get)
+        if fastest != "fft" and not spectrum_kept:
+            # Only timing needed it
+            kernel.spectra.pop(self.complex_dtype, None)
+        return fastest
+
+    def fft_convolve(self, kernel, out):
+        workspace = self.workspace
+        spectrum_shape = self.cells.shape[:-1] + (self.shape[1]//2+1,)
+        if self.cells_fft is None:
+            cells = self.cells
+            if cells.dtype != self.dtype:
+                cells = workspace.get("cells", cells.shape, self.dtype)
+                np.copyto(cells, self.cells)
+            # rfft2/irfft2 allocate full-grid temporaries even when given
+            # out=, transforming one axis at a time in place does not
+            spectrum = workspace.get("cells_fft", spectrum_shape, self.complex_dtype)
+            np.fft.rfft(cells, axis=-1, out=spectrum)
+            self.cells_fft = np.fft.fft(spectrum, axis=-2, out=spectrum)
+        product = workspace.get("product", spectrum_shape, self.complex_dtype)
+        np.multiply(self.cells_fft, kernel.spectrum(self.complex_dtype), out=product)
+        np.fft.ifft(product, axis=-2, out=product)
+        return np.fft.irfft(product, self.shape[1], axis=-1, out=out)
+
+    def box_convolve(self, kernel, out):
+        workspace = self.workspace
+        if self.cells_table is None or self.table_pad < kernel.size:
+            pad = max(k.size for k in self.kernels.values() if k.boxes is not None)
+            shape = self.cells.shape[:-2] + (self.shape[0]+2*pad+1, self.shape[1]+2*pad+1)
+            table_dtype = np.int32 if self.cells.dtype.kind in "biu" else np.dtype(float)
+            self.table_pad = pad
+            self.cells_table = summed_area_table(self.cells, pad, workspace.get("table", shape, table_dtype))
+        scratch = workspace.get("scratch", self.cells.shape, self.dtype)
+        sums = workspace.get("box sums", self.cells.shape, self.cells_table.dtype)
+        return box_conv2d(self.cells_table, self.table_pad, kernel, self.shape, self.dtype, out, scratch, sums)
+
+    def separable_convolve(self, kernel, out):
+        scratch = self.workspace.get("scratch", self.cells.shape, self.dtype)
+        return separable_conv2d(self.cells, kernel, self.dtype, out, scratch)
+
+    def direct_convolve(self, kernel, out):
+        return direct_conv2d(self.cells, kernel, self.dtype, out)
+
+
+class ChannelConvolution:
+    # The densities of C coupled channels, channel i seeing
+    #
+    #   sum_j weights[i][j] * (couplings[i][j] * cells[j]) / sum(couplings[i][j])
+    #
+    # couplings is a C x C nested list of Kernels, None where channel j does
+    # not reach channel i. Every channel goes through one batched forward
+    # transform, the C x C products are summed in the spectral domain by one
+    # einsum over the stacked kernel spectra (weights and normalisation
+    # folded in), and C inverse transforms follow, instead of the C*C
+    # separate convolutions.
+    def __init__(self, couplings, weights, shape, dtype=float, workspace=None):
+        self.couplings = couplings
+        self.weights = np.asarray(weights, dtype=float)
+        self.shape = shape
+        self.dtype = np.dtype(dtype)
+        self.complex_dtype = np.result_type(self.dtype, np.complex64)
+        self.workspace = workspace if workspace is not None else Workspace()
+        # The kernel spectra and weights the stacked spectra were built from
+        self.rule = None
+
+    def stacked_spectra(self):
+        channels = len(self.couplings)
+        for row in self.couplings:
+            for kernel in row:
+                if kernel is not None and kernel.stale:
+                    kernel.update_fft()
+        rule = (tuple(kernel.key if kernel is not None else None for row in self.couplings for kernel in row),
+                self.weights.tobytes())
+        spectra = self.workspace.get("channel spectra", (channels, channels, self.shape[0], self.shape[1]//2+1),
+                                     self.complex_dtype)
+        if rule != self.rule:
+            spectra.fill(0)
+            for i, row in enumerate(self.couplings):
+                for j, kernel in enumerate(row):
+                    if kernel is not None:
+                        np.multiply(kernel.spectrum(self.complex_dtype), self.weights[i, j]/np.sum(kernel.values),
+                                    out=spectra[i, j], casting="same_kind")
+            self.rule = rule
+        return spectra
+
+    def convolve(self, cells, out=None):
+        # cells is (C, width, height), the densities come out the same shape
+        workspace = self.workspace
+        spectra = self.stacked_spectra()
+        spectrum_shape = cells.shape[:-1] + (self.shape[1]//2+1,)
+        if cells.dtype != self.dtype:
+            converted = workspace.get("channel cells", cells.shape, self.dtype)
+            np.copyto(converted, cells)
+            cells = converted
+        spectrum = workspace.get("channel fft", spectrum_shape, self.complex_dtype)
+        np.fft.rfft(cells, axis=-1, out=spectrum)
+        np.fft.fft(spectrum, axis=-2, out=spectrum)
+        product = workspace.get("channel product", spectrum_shape, self.complex_dtype)
+        np.einsum("ijxy,jxy->ixy", spectra, spectrum, out=product)
+        np.fft.ifft(product, axis=-2, out=product)
+        if out is None:
+            out = workspace.get("channel density", cells.shape, self.dtype)
+        return np.fft.irfft(product, self.shape[1], axis=-1, out=out)
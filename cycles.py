@@ -0,0 +1,42 @@
+import hashlib
+from collections import OrderedDict
+
+# Detects when the cells return to a state they were in before. The rule is
+# deterministic, so from then on the run goes round the same cycle of
+# states forever (as long as the rule values and the kernel stay the same),
+# and everything derived from it repeats with the same period.
+
+class CycleDetector:
+    # Keeps the hashes of the last `capacity` distinct states with the step
+    # each was last seen at, so cycles up to that period are noticed
+    def __init__(self, capacity=256):
+        self.capacity = capacity
+        self.seen = OrderedDict()
+        self.rule = None
+        # Period of the cycle the last observed state is on, if any, and a
+        # (step, period) event for every cycle entered
+        self.period = None
+        self.events = []
+
+    def observe(self, packed, step, rule=None):
+        # Returns the period if the packed cells were seen before, else None
+        if rule != self.rule:
+            # The same cells lead somewhere else under another rule
+            self.seen.clear()
+            self.rule = rule
+        digest = hashlib.blake2b(packed.tobytes(), digest_size=16).digest()
+        first = self.seen.pop(digest, None)
+        self.seen[digest] = step
+        if len(self.seen) > self.capacity:
+            self.seen.popitem(last=False)
+        period = None if first is None else step - first
+        if period is not None and period != self.period:
+            self.events.append((step, period))
+        self.period = period
+        return period
+
+    def shift(self, steps):
+        # Moves the recorded steps forward by a whole number of periods, for
+        # runs that skipped round the cycle without observing it
+        for digest in self.seen:
+            self.seen[digest] += steps
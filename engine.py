@@ -0,0 +1,584 @@
+from collections import deque
+
+import numpy as np
+from scipy.ndimage import gaussian_filter
+from convolution import Kernel, ConvolutionStage, ChannelConvolution
+from metrics import MetricHistory, default_specs
+import sparse
+from cycles import CycleDetector
+import profiling
+from workspace import Workspace
+
+# Headless stepping engine. Imports nothing from gui/glumpy, so it can run
+# batch jobs on machines without a display.
+
+default_values = {
+    "deadMin": 0.15,
+    "popMax" : 0.5,
+    "birthMin" : 0.6,
+    "lifeMin" : 0.5,
+}
+
+def gaussian_kernel(cells_shape, size=33, sigma=30):
+    mu = size // 2
+    values = np.fromfunction(lambda x, y: np.exp(-(x-mu)**2 / sigma - (y-mu)**2 / sigma), (size, size))
+    return Kernel(values/np.max(values), cells_shape)
+
+def circle_kernel(cells_shape, size=33, radius=2, sigma=2):
+    center = size // 2
+    def circle_fn(x,y):
+        dist = np.sqrt((x-center)**2 + (y-center)**2)
+        return np.exp(-(dist-radius)**2 / sigma)
+    values = np.fromfunction(circle_fn, (size, size))
+    return Kernel(values/np.max(values), cells_shape)
+
+def checkerboard_kernel(cells_shape, size=16):
+    half_size = size//2
+    values = np.zeros((size, size))
+    values[:half_size, :half_size] = 1.0
+    values[half_size:, half_size:] = 1.0
+    return Kernel(gaussian_filter(values, 0.1), cells_shape)
+
+kernel_builders = {
+    "gaussian": gaussian_kernel,
+    "circle": circle_kernel,
+    "checkerboard": checkerboard_kernel,
+}
+
+def default_kernels(cells_shape):
+    return {name: build(cells_shape) for name, build in kernel_builders.items()}
+
+# A metric is in bounds when its whole history lies strictly inside the limits,
+# and the game is won once every metric stayed in bounds for more than
+# win_frames consecutive steps
+win_limits = {
+    "derivative_metric": (11, 17),
+    "gaussian_metric": (6000, 14000),
+}
+win_frames = 100
+
+def random_cells(width, height, rng, count=None):
+    shape = (width, height) if count is None else (count, width, height)
+    return (rng.uniform(0, 1, shape) > 0.5).astype(float)
+
+def apply_rule(density, cells, values, workspace=None):
+    # Boolean mask of the next state, in the workspace's "rule" buffer.
+    # Works elementwise, so values may be scalars or arrays broadcasting
+    # against the cells (one threshold set per ensemble member).
+    #   (density < popMax) & ((density > 1-birthMin) | ((density > deadMin) & (cells > lifeMin)))
+    if workspace is None:
+        workspace = Workspace()
+    shape = density.shape
+    new_cells = np.less(density, values["popMax"], out=workspace.get("rule", shape, bool))
+    birth = np.greater(density, 1-values["birthMin"], out=workspace.get("birth", shape, bool))
+    survive = np.greater(density, values["deadMin"], out=workspace.get("survive", shape, bool))
+    alive = np.greater(cells, values["lifeMin"], out=workspace.get("alive", shape, bool))
+    survive &= alive
+    birth |= survive
+    new_cells &= birth
+    return new_cells
+
+# The frame for each view mode of the GUI (its "showFourier" value): the
+# cells, their log spectrum, the derivative or the filtered derivative
+def view(engine, mode=0):
+    if mode == 1:
+        with engine.profiler.phase("fourier view"):
+            fourier = np.absolute(np.fft.fft2(engine.simulation_cells))
+            fourier = np.log(fourier+1)
+            return fourier / fourier.max()
+    if mode == 2:
+        return engine.derivative
+    if mode == 3:
+        return engine.g_filtered
+    return engine.simulation_cells
+
+# Binary cells packed eight to a byte along the last axis, float cells
+# count as alive above 0.5
+def pack_cells(cells):
+    if cells.dtype != bool:
+        cells = cells > 0.5
+    return np.packbits(cells, axis=-1)
+
+def unpack_cells(packed, height):
+    return np.unpackbits(packed, axis=-1, count=height).view(bool)
+
+# How Engine keeps the binary cell state between steps: "float" as 0/1 in
+# the engine dtype, "bool" one byte per cell, "packed" one bit per cell
+storages = ("float", "bool", "packed")
+
+
+class WinCondition:
+    # Metric histories and the win condition over them, shared by the
+    # engines that step a single grid. The win condition looks at the newest
+    # metricPoints samples, metric_capacity of them are kept. metric_specs
+    # say how and how often each metric is computed, see metrics.py.
+    metricPoints = 100
+
+    def reset_metrics(self, metric_capacity=None, metric_specs=None):
+        self.metric_specs = metric_specs if metric_specs is not None else default_specs()
+        self.metrics = {name: MetricHistory(self.metricPoints, metric_capacity, self.win_limits.get(name))
+                        for name in self.metric_specs}
+        self.win_condition = {name: False for name in self.win_limits}
+        self.won = False
+        # Set when a step changed no cell, the state is then a fixed point
+        self.frozen = False
+
+    # The newest metricPoints samples, newest first, as views
+    @property
+    def derivative_metric(self):
+        return self.metrics["derivative_metric"].newest_first()
+
+    @property
+    def gaussian_metric(self):
+        return self.metrics["gaussian_metric"].newest_first()
+
+    @property
+    def time_within_bounds(self):
+        return {name: int(self.metrics[name].streak) for name in self.win_limits}
+
+    def metrics_due(self, shown=True):
+        return [name for name, spec in self.metric_specs.items() if spec.due(self.steps, shown)]
+
+    def record_metrics(self, changed, names=None):
+        # Appends the metrics named (all of them by default) for a step that
+        # changed this many cells
+        for name in self.metric_specs if names is None else names:
+            self.metrics[name].append(self.metric_specs[name].compute(changed, self))
+        self.frozen = changed == 0
+        self.update_win_condition()
+
+    def update_win_condition(self):
+        for name in self.win_limits:
+            self.win_condition[name] = self.metrics[name].streak > win_frames
+        self.won = self.won or all(self.win_condition.values())
+
+    def steps_to_win(self):
+        # Lower bound on the steps still needed, assuming every future sample
+        # lands in bounds. Metrics sampled every k steps take k steps a sample.
+        needed = 0
+        for name in self.win_limits:
+            history = self.metrics[name]
+            if history.streak > 0:
+                samples = win_frames + 1 - history.streak
+            else:
+                # The newest out of bounds sample has to leave the window first
+                samples = history.window - history.inside_run + win_frames
+            needed = max(needed, (samples-1) * self.metric_specs[name].every + 1)
+        return int(needed)
+
+    def can_win(self, steps_left):
+        if self.won:
+            return True
+        if self.frozen:
+            # A fixed point keeps producing its last metric values
+            for name in self.win_limits:
+                history = self.metrics[name]
+                if not history.inside(history.latest):
+                    return False
+        period = getattr(self, "cycle_period", None)
+        if period is not None:
+            # A cycle keeps repeating the samples of its last period. One
+            # outside the limits is in every window if the period fits in it.
+            for name in self.win_limits:
+                history = self.metrics[name]
+                if self.metric_specs[name].every != 1:
+                    continue
+                if period <= history.window and not history.inside(history.last(period)).all():
+                    return False
+        return self.steps_to_win() <= steps_left
+
+
+class Engine(WinCondition):
+    def __init__(self, width, height, values=None, kernels=None, rule_kernel="checkerboard", cells=None, seed=None, win_limits=win_limits,
+                 dtype=float, storage="float", history_length=0, metric_capacity=None, metric_specs=None, tile_size=None,
+                 cycle_capacity=0):
+        self.width = width
+        self.height = height
+        self.win_limits = win_limits
+        # dtype of the convolution path, float32 halves its memory traffic
+        self.dtype = np.dtype(dtype)
+        if storage not in storages:
+            raise ValueError("storage must be one of %s" % (storages,))
+        self.storage = storage
+        # With a tile size, quiet regions are skipped, see sparse.py
+        if tile_size and (width % tile_size or height % tile_size):
+            raise ValueError("tile_size must divide the grid")
+        self.tile_size = tile_size
+        # The rule values and kernel analysis the last step used, sparse
+        # steps are only valid while they stay the same
+        self.last_rule = None
+        # The dict is kept by reference, so a GUI can change it between steps
+        self.values = values if values is not None else dict(default_values)
+        self.kernels = kernels if kernels is not None else default_kernels((width, height))
+        self.rule_kernel = rule_kernel
+
+        self.rng = np.random.default_rng(seed)
+        if cells is None:
+            cells = random_cells(width, height, self.rng)
+        # Every full-grid intermediate of a step lives in here
+        self.workspace = Workspace()
+        self.simulation_cells = np.asarray(cells) > 0.5
+        self.derivative = self.workspace.get("derivative", (width, height), bool)
+        self.derivative.fill(False)
+        # The step the derivative was last computed for, and the one
+        # g_filtered was last filtered from
+        self.derivative_step = 0
+        self.filtered_step = None
+        # The full grid convolves as the tiles do, see sparse.py
+        self.convolution = ConvolutionStage(self.kernels, (width, height), self.dtype, self.workspace,
+                                            exact=bool(tile_size))
+        # Last history_length states, packed, newest last
+        self.history = deque(maxlen=history_length)
+        # Notices when the cells repeat, see cycles.py
+        self.cycles = CycleDetector(cycle_capacity) if cycle_capacity else None
+        self.cycle_period = None
+        # Gets every stepped state, e.g. a recording.Recorder
+        self.recorder = None
+        # Times the phases of a step, see profiling.py
+        self.profiler = profiling.disabled
+
+        self.steps = 0
+        self.reset_metrics(metric_capacity, metric_specs)
+
+    @property
+    def simulation_cells(self):
+        if self.storage == "packed":
+            return unpack_cells(self.state, self.height)
+        return self.state
+
+    @simulation_cells.setter
+    def simulation_cells(self, cells):
+        # Takes a boolean mask
+        if self.storage == "packed":
+            self.state = pack_cells(cells)
+        elif self.storage == "bool":
+            self.state = self.workspace.get("state", cells.shape, bool)
+            np.copyto(self.state, cells)
+        else:
+            self.state = self.workspace.get("state", cells.shape, self.dtype)
+            np.copyto(self.state, cells)
+
+    def paint(self, x, y, value):
+        # Sets cells[x, y] for index or slice x and y, whatever the storage
+        if self.storage == "packed":
+            cells = self.simulation_cells
+            cells[x, y] = value
+            self.simulation_cells = cells
+        else:
+            self.state[x, y] = value
+        # Painted cells are not in the derivative, the next step is a full one
+        self.last_rule = None
+
+    @property
+    def g_filtered(self):
+        # The derivative smoothed for display, only filtered when asked for
+        g_filtered = self.workspace.get("g_filtered", (self.width, self.height), self.dtype)
+        if self.filtered_step != self.derivative_step:
+            with self.profiler.phase("filtered view"):
+                gaussian_filter(self.derivative, 6, output=g_filtered)
+            self.filtered_step = self.derivative_step
+        return g_filtered
+
+    def convolve(self, name):
+        # Convolution of the state the current step started from
+        return self.convolution.convolve(name)
+
+    def step(self, n=1, shown=True):
+        for _ in range(n):
+            self.step_once(shown)
+        return self
+
+    def rule(self):
+        # What the next state depends on besides the cells
+        kernel = self.kernels[self.rule_kernel]
+        return tuple(self.values[key] for key in default_values), kernel.key, kernel.stale
+
+    def step_once(self, shown=True):
+        rule = self.rule()
+        active = self.active_tiles(rule)
+        if active is not None:
+            self.step_tiles(active, shown)
+        else:
+            self.step_grid(shown)
+        self.last_rule = rule
+        self.steps += 1
+        if self.cycles is not None:
+            with self.profiler.phase("cycles"):
+                packed = self.state if self.storage == "packed" else pack_cells(self.simulation_cells)
+                self.cycle_period = self.cycles.observe(packed, self.steps, rule)
+        if self.recorder is not None:
+            with self.profiler.phase("record"):
+                self.recorder.record_engine(self)
+
+    def fast_forward_blocker(self):
+        # Why fast_forward cannot run now, or None if it can
+        period = self.cycle_period
+        if period is None:
+            return "not in a cycle"
+        for name, spec in self.metric_specs.items():
+            history = self.metrics[name]
+            if spec.every != 1 or history.samples < period or history.capacity < period:
+                return "metric %s does not hold a whole period" % name
+        if self.history.maxlen and self.history.maxlen < period:
+            return "the state history does not hold a whole period"
+        return None
+
+    def fast_forward(self, n):
+        # Advances n steps round the detected cycle. Whole periods leave the
+        # cells as they are and repeat the metric samples of the last period,
+        # only the remainder is actually stepped.
+        period = self.cycle_period
+        reason = self.fast_forward_blocker()
+        if reason:
+            raise ValueError(reason)
+        samples = {name: history.last(period).copy() for name, history in self.metrics.items()}
+        derivative_current = self.derivative_step == self.steps
+        for i in range(n - n % period):
+            for name, history in self.metrics.items():
+                history.append(samples[name][i % period])
+            self.update_win_condition()
+            if self.history.maxlen:
+                self.history.append(self.history[-period])
+            self.steps += 1
+        if derivative_current:
+            # Whole periods end on the same transition
+            self.derivative_step = self.steps
+        self.cycles.shift(n - n % period)
+        return self.step(n % period)
+
+    def active_tiles(self, rule):
+        # The tiles to recompute, or None when the whole grid has to be
+        # stepped: without a derivative of the last step, after the rule or
+        # the cells were changed from outside, or when too much is going on
+        if not self.tile_size or self.derivative_step != self.steps:
+            return None
+        if rule[2] or rule != self.last_rule:
+            return None
+        kernel = self.kernels[self.rule_kernel]
+        active = sparse.active_tiles(self.derivative, self.tile_size, kernel)
+        if active.mean() > sparse.activity_limit:
+            return None
+        return active
+
+    def step_tiles(self, active, shown):
+        # Recomputes the active tiles in place, the rest carry over
+        tile = self.tile_size
+        cells = self.simulation_cells
+        ix, iy = np.nonzero(active)
+        # Tile views of the grids: [ix, :, iy, :] picks (tiles, tile, tile)
+        tiles_shape = (self.width//tile, tile, self.height//tile, tile)
+        derivative = self.derivative.reshape(tiles_shape)
+        derivative.fill(False)
+        if len(ix):
+            with self.profiler.phase("convolution"):
+                kernel = self.kernels[self.rule_kernel]
+                backend = kernel.exact_backend(cells.shape)
+                density = sparse.tile_density(cells, ix, iy, tile, kernel, backend, self.dtype)
+            with self.profiler.phase("rule"):
+                cell_tiles = cells.reshape(tiles_shape)
+                old = cell_tiles[ix, :, iy, :]
+                new = apply_rule(density, old, self.values)
+                derivative[ix, :, iy, :] = new != (old > 0.5)
+                cell_tiles[ix, :, iy, :] = new
+                if self.storage == "packed":
+                    self.simulation_cells = cells
+        self.derivative_step = self.steps + 1
+        with self.profiler.phase("metrics"):
+            self.record_metrics(np.count_nonzero(derivative), self.metrics_due(shown))
+        if self.history.maxlen:
+            self.history.append(pack_cells(cells))
+
+    def step_grid(self, shown):
+        # Everything full-grid is written into workspace buffers
+        workspace = self.workspace
+        profiler = self.profiler
+        shape = (self.width, self.height)
+        values = self.values
+        cells = self.simulation_cells
+        self.convolution.reset(cells)
+
+        kernel = self.kernels[self.rule_kernel]
+        with profiler.phase("convolution"):
+            convolved = self.convolve(self.rule_kernel)
+        with profiler.phase("rule"):
+            density = workspace.get("density", shape, self.dtype)
+            np.divide(convolved, float(np.sum(kernel.values)), out=density)
+            new_cells = apply_rule(density, cells, values, workspace)
+
+        # Determines the derivative, unless neither a metric nor the view
+        # needs it. Steps that are not shown (turbo, see runner.py) skip the
+        # displayed metrics.
+        due = self.metrics_due(shown)
+        if due or shown:
+            with profiler.phase("metrics"):
+                if cells.dtype != bool:
+                    cells = np.greater(cells, 0.5, out=workspace.get("old", shape, bool))
+                np.not_equal(new_cells, cells, out=self.derivative)
+                self.derivative_step = self.steps + 1
+                self.record_metrics(np.count_nonzero(self.derivative), due)
+
+        if self.history.maxlen:
+            self.history.append(pack_cells(new_cells))
+        if self.storage == "bool":
+            # The old state's buffer takes the next step's rule output
+            self.state = workspace.swap("state", "rule")
+        else:
+            self.simulation_cells = new_cells
+
+class Ensemble:
+    # B independent grids stepped together as one (B, width, height) array.
+    # Every member shares the kernels, but has its own rule thresholds.
+    metricPoints = Engine.metricPoints
+
+    def __init__(self, width, height, values, kernels=None, rule_kernel="checkerboard", cells=None, seed=None, win_limits=win_limits):
+        self.width = width
+        self.height = height
+        self.win_limits = win_limits
+        values = dict(default_values, **values)
+        count = np.broadcast(*[np.asarray(v) for v in values.values()]).size
+        self.count = count
+        self.values = {key: np.broadcast_to(np.asarray(v, dtype=float), (count,)).reshape(count, 1, 1) for key, v in values.items()}
+        self.kernels = kernels if kernels is not None else default_kernels((width, height))
+        self.rule_kernel = rule_kernel
+
+        self.rng = np.random.default_rng(seed)
+        if cells is None:
+            cells = random_cells(width, height, self.rng, count)
+        self.simulation_cells = np.array(np.broadcast_to(cells, (count, width, height)), dtype=float)
+        self.new_cells = np.zeros_like(self.simulation_cells)
+        self.derivative = np.zeros_like(self.simulation_cells)
+        self.convolution = ConvolutionStage(self.kernels, (width, height))
+
+        self.metric_specs = default_specs()
+        self.metrics = {name: MetricHistory(self.metricPoints, limits=self.win_limits.get(name), shape=(count,))
+                        for name in self.metric_specs}
+        self.win_condition = {name: np.zeros(count, dtype=bool) for name in self.win_limits}
+        self.won = np.zeros(count, dtype=bool)
+        self.steps = 0
+
+    # (count, metricPoints) views, newest first
+    @property
+    def derivative_metric(self):
+        return self.metrics["derivative_metric"].newest_first().T
+
+    @property
+    def gaussian_metric(self):
+        return self.metrics["gaussian_metric"].newest_first().T
+
+    @property
+    def time_within_bounds(self):
+        return {name: self.metrics[name].streak for name in self.win_limits}
+
+    def member_values(self, index):
+        return {key: float(v[index, 0, 0]) for key, v in self.values.items()}
+
+    def convolve(self, name):
+        return self.convolution.convolve(name)
+
+    def step(self, n=1):
+        for _ in range(n):
+            self.step_once()
+        return self
+
+    def step_once(self):
+        # The transforms work on the last two axes, so the whole stack goes
+        # through one call each and the kernel spectrum broadcasts over the members
+        self.convolution.reset(self.simulation_cells)
+
+        kernel = self.kernels[self.rule_kernel]
+        density = self.convolve(self.rule_kernel)/np.sum(kernel.values)
+        self.new_cells = apply_rule(density, self.simulation_cells, self.values, self.convolution.workspace).astype(float)
+
+        self.derivative = np.absolute(self.new_cells - self.simulation_cells)
+        changed = np.sum(self.derivative, axis=(1, 2))
+        for name, spec in self.metric_specs.items():
+            if spec.due(self.steps):
+                self.metrics[name].append(spec.compute(changed, self))
+        self.update_win_condition()
+
+        self.simulation_cells, self.new_cells = self.new_cells, self.simulation_cells
+        self.steps += 1
+
+    def update_win_condition(self):
+        for name in self.win_limits:
+            self.win_condition[name] = self.metrics[name].streak > win_frames
+        self.won |= np.logical_and.reduce(list(self.win_condition.values()))
+
+
+class MultiChannel(WinCondition):
+    # C interacting binary fields. couplings is a C x C nested list of
+    # kernel names, couplings[i][j] the kernel through which channel j
+    # counts towards channel i's density (None for no influence), weighted
+    # by weights[i][j]; by default each channel's density is the plain mean
+    # over what reaches it, so the usual thresholds apply. Each rule value
+    # is a scalar or one per channel. See ChannelConvolution for the batched
+    # transforms. The metrics count changed cells over all channels.
+    def __init__(self, width, height, couplings, weights=None, values=None, kernels=None, cells=None, seed=None,
+                 win_limits=win_limits, dtype=float, metric_capacity=None, metric_specs=None):
+        self.width = width
+        self.height = height
+        self.win_limits = win_limits
+        self.dtype = np.dtype(dtype)
+        self.kernels = kernels if kernels is not None else default_kernels((width, height))
+        self.couplings = couplings
+        count = len(couplings)
+        if any(len(row) != count for row in couplings):
+            raise ValueError("couplings must be a square matrix")
+        self.count = count
+        present = np.array([[name is not None for name in row] for row in couplings], dtype=float)
+        if weights is None:
+            weights = present / np.maximum(present.sum(axis=1, keepdims=True), 1)
+        self.weights = np.asarray(weights, dtype=float)
+        if self.weights.shape != (count, count):
+            raise ValueError("weights must be %d x %d" % (count, count))
+        values = dict(default_values, **(values or {}))
+        self.values = {key: np.broadcast_to(np.asarray(v, dtype=float), (count,)).reshape(count, 1, 1) for key, v in values.items()}
+
+        self.rng = np.random.default_rng(seed)
+        if cells is None:
+            cells = random_cells(width, height, self.rng, count)
+        self.workspace = Workspace()
+        self.state = self.workspace.get("state", (count, width, height), bool)
+        np.greater(np.broadcast_to(cells, (count, width, height)), 0.5, out=self.state)
+        self.derivative = self.workspace.get("derivative", (count, width, height), bool)
+        self.derivative.fill(False)
+        self.convolution = ChannelConvolution(
+            [[self.kernels[name] if name is not None else None for name in row] for row in couplings],
+            self.weights, (width, height), self.dtype, self.workspace)
+        # Cells each channel changed in the last step
+        self.channel_changes = np.zeros(count, dtype=int)
+        # Times the phases of a step, see profiling.py
+        self.profiler = profiling.disabled
+
+        self.steps = 0
+        self.reset_metrics(metric_capacity, metric_specs)
+
+    @property
+    def simulation_cells(self):
+        # (C, width, height), a boolean mask per channel
+        return self.state
+
+    def paint(self, x, y, value, channel=0):
+        self.state[channel, x, y] = value
+
+    def step(self, n=1, shown=True):
+        for _ in range(n):
+            self.step_once(shown)
+        return self
+
+    def step_once(self, shown=True):
+        workspace = self.workspace
+        profiler = self.profiler
+        cells = self.state
+        with profiler.phase("convolution"):
+            density = self.convolution.convolve(cells)
+        with profiler.phase("rule"):
+            new_cells = apply_rule(density, cells, self.values, workspace)
+        due = self.metrics_due(shown)
+        with profiler.phase("metrics"):
+            np.not_equal(new_cells, cells, out=self.derivative)
+            self.channel_changes = np.count_nonzero(self.derivative, axis=(1, 2))
+            self.record_metrics(int(self.channel_changes.sum()), due)
+        # The old state's buffer takes the next step's rule output
+        self.state = workspace.swap("state", "rule")
+        self.steps += 1
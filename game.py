@@ -7,13 +7,31 @@ import scipy
 import scipy.signal
 from glumpy import app, gl, glm, gloo
 import gui
-from simulation import Simulation
+import profiling
+from simulation import Simulation, ReplaySimulation
+from recording import Recorder, Replay
+from runner import to_frame
 from os import path
+import argparse
 
 MOUSE_MULTIPLIER = 1.0
 if path.exists("stepan"):
     MOUSE_MULTIPLIER = 2.0
 
+# glumpy parses its own options from the same command line
+parser = argparse.ArgumentParser()
+parser.add_argument("--threaded", action="store_true", help="step the simulation on a background thread")
+parser.add_argument("--turbo", type=int, default=1, help="simulation steps per shown frame")
+parser.add_argument("--texture", default="float32", choices=["float32", "uint8"], help="format of the uploaded textures")
+parser.add_argument("--record", metavar="PATH", help="record every step to a file")
+parser.add_argument("--replay", metavar="PATH", help="play a recording back instead of simulating")
+parser.add_argument("--profile", metavar="PATH", nargs="?", const="",
+                    help="time the step and render phases, show them in the GUI strip and dump them to PATH")
+parser.add_argument("--size", default="512", help="grid size, N or WIDTHxHEIGHT, shown through a 512x512 viewport")
+parser.add_argument("--lod", default="max", choices=["max", "min", "mean"],
+                    help="how cells are reduced when zoomed out")
+options, _ = parser.parse_known_args()
+
 render_vertex = """
 attribute vec2 position;
 attribute vec2 texcoord;
@@ -36,14 +54,52 @@ void main()
 }
 """
 
-window = app.Window(width=512, height=512+100)
 gui_height = 100
+# The window shows cwidth x cheight pixels of a grid of any size, scroll
+# zooms, dragging with the right button pans and 0 shows all of it again
 cwidth, cheight = 512, 512
-
-all_pixels = np.zeros((cwidth, cheight+gui_height, 4))
+gwidth, _, gheight = options.size.partition("x")
+gwidth, gheight = int(gwidth), int(gheight or gwidth)
+if options.replay:
+    replay = Replay(options.replay)
+    gwidth, gheight = replay.width, replay.height
+    replay.close()
+window = app.Window(width=cwidth, height=cheight+gui_height)
+
+# The simulation and the GUI strip are single channel textures of their own,
+# uploaded separately and drawn on two quads, the GUI at the bottom
+texture_dtype = np.dtype(options.texture)
+texture_type = gloo.TextureFloat2D if texture_dtype.kind == "f" else gloo.Texture2D
 
 GUI = gui.GUI(cwidth, gui_height)
-simulation = Simulation(cwidth, cheight, GUI)
+GUI.values["turbo"] = options.turbo
+if options.replay:
+    simulation = ReplaySimulation(options.replay, GUI, (cwidth, cheight), options.lod)
+else:
+    simulation = Simulation(gwidth, gheight, GUI, (cwidth, cheight), options.lod)
+recorder = None
+if options.record and not options.replay:
+    recorder = Recorder(options.record, gwidth, gheight, list(simulation.engine.metrics))
+    simulation.engine.recorder = recorder
+profiler = profiling.disabled
+if options.profile is not None:
+    profiler = profiling.Profiler(dump_path=options.profile or None)
+    if not options.replay:
+        simulation.engine.profiler = profiler
+    GUI.objects.append(gui.ProfileBar(280, 64, cwidth-290, 4, profiler))
+if options.threaded and not options.replay:
+    # The published frames are textures themselves, the stepping thread
+    # renders straight into what gets uploaded
+    simulation.start(texture_dtype, texture_type)
+    frames_version = -1
+sim_pixels = np.zeros((cwidth, cheight), texture_dtype).view(texture_type)
+gui_pixels = np.zeros((cwidth, gui_height), texture_dtype).view(texture_type)
+
+def upload(texture, data):
+    # Converts into the texture's own memory, a plain assignment would
+    # allocate a temporary, and marks all of it for upload
+    to_frame(data, texture.view(np.ndarray))
+    texture._add_pending_data(0, texture.nbytes)
 
 # GUI.objects.append(gui.KernelPainter(160, 0, simulation.kernel))
 # GUI.objects.append(gui.KernelPainter(190, 0, simulation.gaussian_kernel))
@@ -51,22 +107,47 @@ simulation = Simulation(cwidth, cheight, GUI)
 
 @window.event
 def on_draw(dt):
+    global frames_version
+    # The simulation's steps time their own phases
     simulation.on_draw(dt)
-    GUI.on_draw(dt)
-
-    render["texture"][:, gui_height:gui_height+cheight, 0] = simulation.cells
-    render["texture"][:, :gui_height, 0] = GUI.pixels
+    with profiler.phase("gui"):
+        gui_changed = GUI.on_draw(dt)
+
+    with profiler.phase("upload"):
+        if simulation.runner is not None:
+            frames = simulation.runner.frames
+            if frames.version != frames_version:
+                frames_version = frames.version
+                frame = simulation.cells
+                if render_sim["texture"] is not frame:
+                    render_sim["texture"] = frame
+                    frame.interpolation = gl.GL_LINEAR
+                    frame.wrapping = gl.GL_CLAMP_TO_EDGE
+                frame._add_pending_data(0, frame.nbytes)
+        else:
+            upload(sim_pixels, simulation.cells)
+        # The GUI strip rarely changes, it is only uploaded when it did
+        if gui_changed:
+            upload(gui_pixels, GUI.pixels)
 
     # gl.glDisable(gl.GL_BLEND)
     # gl.glClear(gl.GL_COLOR_BUFFER_BIT)
-    gl.glViewport(0, 0, window.width, window.height)
-    render.draw(gl.GL_TRIANGLE_STRIP)
+    # glumpy transfers pending texture data when drawing, so the time spent
+    # sending textures to the GPU counts here
+    with profiler.phase("draw"):
+        gl.glViewport(0, 0, window.width, window.height)
+        render_sim.draw(gl.GL_TRIANGLE_STRIP)
+        render_gui.draw(gl.GL_TRIANGLE_STRIP)
+    profiler.end_frame()
 
 # ===== MOUSE EVENTS =====
 
 @window.event
 def on_mouse_drag(x, y, dx, dy, button):
     x,y = x/MOUSE_MULTIPLIER, y/MOUSE_MULTIPLIER
+    if button == app.window.mouse.RIGHT and window.height - y > gui_height:
+        simulation.viewport.pan(dx/MOUSE_MULTIPLIER, -dy/MOUSE_MULTIPLIER)
+        return
     GUI.on_mouse_drag(x, window.height-y, dx, dy, button)
     # normalizovaná myš
     if window.height - y > gui_height:
@@ -79,6 +160,12 @@ def on_mouse_motion(x, y, dx, dy):
     x,y = x/MOUSE_MULTIPLIER, y/MOUSE_MULTIPLIER
     GUI.on_mouse_motion(x, window.height-y, dx, dy)
 
+@window.event
+def on_mouse_scroll(x, y, dx, dy):
+    x,y = x/MOUSE_MULTIPLIER, y/MOUSE_MULTIPLIER
+    if window.height - y > gui_height:
+        simulation.viewport.zoom_at(2**(dy/4), x*cwidth/window.width, window.height-y-gui_height)
+
 @window.event
 def on_mouse_press(x, y, button):
     GUI.on_mouse_press(x, y, button)
@@ -91,14 +178,28 @@ def on_key_press(symbol, modifiers):
 
 @window.event
 def on_character(text):
+    if text == "0":
+        simulation.viewport.fit()
     GUI.on_character(text)
 
-render = gloo.Program(render_vertex, render_fragment, count=4)
-render["position"] = [(-1, -1), (-1, +1), (+1, -1), (+1, +1)]
-render["texcoord"] = [(0, 0), (0, 1), (1, 0), (1, 1)]
-render["texture"] = all_pixels
-# render["texture"] = np.random.uniform(0, 1, (cwidth, cheight, 4)) > 0.5
-render["texture"].interpolation = gl.GL_LINEAR
-render["texture"].wrapping = gl.GL_CLAMP_TO_EDGE
-
-app.run(framerate=0)
+def quad(bottom, top, texture):
+    program = gloo.Program(render_vertex, render_fragment, count=4)
+    program["position"] = [(-1, bottom), (-1, top), (+1, bottom), (+1, top)]
+    program["texcoord"] = [(0, 0), (0, 1), (1, 0), (1, 1)]
+    program["texture"] = texture
+    program["texture"].interpolation = gl.GL_LINEAR
+    program["texture"].wrapping = gl.GL_CLAMP_TO_EDGE
+    return program
+
+split = -1 + 2*gui_height/(cheight+gui_height)
+render_sim = quad(split, +1, sim_pixels)
+render_gui = quad(-1, split, gui_pixels)
+
+try:
+    app.run(framerate=0)
+finally:
+    simulation.stop()
+    if recorder is not None:
+        recorder.close()
+    if profiler.enabled and profiler.dump_path:
+        profiler.dump()
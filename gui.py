@@ -1,6 +1,14 @@
 import numpy as np
 from glumpy import app
 
+# Widgets are retained: GUI.on_draw only renders the ones that marked
+# themselves dirty (and whatever overlaps them), the rest of GUI.pixels
+# stays as it was.
+
+def overlaps(a, b):
+    return (a.x < b.x+b.width and b.x < a.x+a.width and
+            a.y < b.y+b.height and b.y < a.y+a.height)
+
 class Rectangle:
     def __init__(self, x, y, width, height, color):
         self.x = x
@@ -8,6 +16,7 @@ class Rectangle:
         self.width = width
         self.height = height
         self.color = color
+        self.dirty = True
 
     def render(self, pixels):
         pixels[self.x:self.x+self.width, self.y:self.y+self.height] = self.color
@@ -17,6 +26,8 @@ class KernelPainter:
         self.x = x
         self.y = y
         self.kernel = kernel
+        self.width, self.height = kernel.shape
+        self.dirty = True
 
     def render(self, pixels):
         width, height = self.kernel.shape
@@ -33,15 +44,16 @@ class KernelPainter:
         if x >= self.x and x < self.x+width and y >= self.y and y < self.y + height:
             relx = x - self.x
             rely = y - self.y
-            for kx in range(self.kernel.shape[0]):
-                for ky in range(self.kernel.shape[1]):
-                    dx, dy = relx - kx, rely - ky
-                    sign = +1 if button == 2 else -1
-                    sigma = 3
-                    add = sign * np.exp(- (dx**2) / sigma - (dy**2) / sigma)
-                    new_val = np.clip(self.kernel.values[kx, ky] + add, 0, 1)
-                    self.kernel.values[kx, ky] = new_val
-            self.kernel.update_fft()
+            kx, ky = np.ogrid[:width, :height]
+            dx, dy = relx - kx, rely - ky
+            sign = +1 if button == 2 else -1
+            sigma = 3
+            add = sign * np.exp(- (dx**2) / sigma - (dy**2) / sigma)
+            np.clip(self.kernel.values + add, 0, 1, out=self.kernel.values)
+            # The spectrum follows on the next step, however many edits
+            # come before it
+            self.kernel.touch()
+            self.dirty = True
             # self.kernel = np.clip(self.kernel, 0, 1)
 
             # if button == 2:
@@ -70,6 +82,17 @@ class Slider:
 
         self.set_value(values[value_key])
 
+    @property
+    def dirty(self):
+        # The value can also change from the keyboard
+        return self.values[self.value_key] != self.shown_value
+
+    @dirty.setter
+    def dirty(self, dirty):
+        # Rendering records the value shown
+        if dirty:
+            self.shown_value = None
+
     def set_value(self, val):
         diff = self.max_val - self.min_val
         self.set_value_relative((val - self.min_val)/diff)
@@ -80,9 +103,12 @@ class Slider:
         diff = self.max_val - self.min_val
         # self.current_val = val*diff + self.min_val
         self.values[self.value_key] = val*diff + self.min_val
-        self.rect_fg.height = int(self.height * val)
+        self.shown_value = None
 
     def render(self, pixels):
+        self.shown_value = self.values[self.value_key]
+        val = (self.shown_value - self.min_val) / (self.max_val - self.min_val)
+        self.rect_fg.height = int(self.height * min(max(val, 0), 1))
         self.rect_bg.render(pixels)
         self.rect_fg.render(pixels)
 
@@ -99,33 +125,34 @@ class Slider:
 
 class Graph(Rectangle):
     def __init__(self, x, y, height, show_array_name, simulation_object, top_limit = 10, bottom_limit = 5):
-        super().__init__(x,y,len(getattr(simulation_object, show_array_name)), height, 0)
+        # Plots simulation_object.metrics[show_array_name], a MetricHistory
+        self.history = simulation_object.metrics[show_array_name]
+        super().__init__(x,y,self.history.window, height, 0)
         self.show_array_name = show_array_name
         self.simulation_object = simulation_object
         self.top_limit = top_limit
         self.bottom_limit = bottom_limit
-        self.time_within_bounds = 0
+        self.shown_samples = None
+
+    @property
+    def dirty(self):
+        return self.history.samples != self.shown_samples
+
+    @dirty.setter
+    def dirty(self, dirty):
+        self.shown_samples = None if dirty else self.history.samples
 
     def render(self, pixels):
+        # The win condition itself is tracked by the engine, this only draws
         top_limit = self.top_limit
         bottom_limit = self.bottom_limit
-        # Plot between max and min in the array
-        show_array = getattr(self.simulation_object, self.show_array_name)
-        bounds = [show_array.min(), show_array.max()]
-        boundedUp, boundedDown = False, False
+        # Plot between max and min in the history, oldest first
+        show_array = self.history.last()
+        bounds = [self.history.min(), self.history.max()]
         if top_limit > bounds[1]:
             bounds[1] = top_limit
-            boundedUp = True
         if bottom_limit < bounds[0]:
             bounds[0] = bottom_limit
-            boundedDown = True
-        if boundedUp and boundedDown:
-            self.time_within_bounds += 1
-            if self.time_within_bounds > 100:
-                self.simulation_object.win_condition[self.show_array_name] = True
-        else:
-            self.time_within_bounds = 0
-            self.simulation_object.win_condition[self.show_array_name] = False
         pixelated = (self.height-1) * (show_array - bounds[0]) / (bounds[1] - bounds[0])
         top_limit = (self.height-1) * (top_limit - bounds[0]) / (bounds[1] - bounds[0])
         bottom_limit = (self.height-1) * (bottom_limit - bounds[0]) / (bounds[1] - bounds[0])
@@ -136,12 +163,41 @@ class Graph(Rectangle):
         # print(min(pixelated))
         # Clear
         pixels[self.x:self.x+self.width, self.y:self.y+self.height] = 0.0
-        # Choose coloured pixels
-        for i in range(len(show_array)):
-            pixels[self.x+i, self.y+pixelated[self.width-1-i]] = 1.0
-            # Draw target lines
-            pixels[self.x+i, self.y+top_limit] = 0.5
-            pixels[self.x+i, self.y+bottom_limit] = 0.5
+        # Choose coloured pixels, the oldest value on the left
+        columns = np.arange(self.x, self.x+self.width)
+        pixels[columns, self.y+pixelated] = 1.0
+        # Draw target lines
+        pixels[self.x:self.x+self.width, self.y+top_limit] = 0.5
+        pixels[self.x:self.x+self.width, self.y+bottom_limit] = 0.5
+
+class ProfileBar(Rectangle):
+    # The median time of each phase a profiling.Profiler saw, stacked left
+    # to right in alternating shades; the full width is `budget` seconds.
+    # Redrawn every `every` frames.
+    shades = [1.0, 0.55, 0.8, 0.35]
+
+    def __init__(self, x, y, width, height, profiler, budget=1/60, every=10):
+        super().__init__(x, y, width, height, 0.1)
+        self.profiler = profiler
+        self.budget = budget
+        self.every = every
+        self.shown_frames = None
+
+    @property
+    def dirty(self):
+        return self.profiler.frames // self.every != self.shown_frames
+
+    @dirty.setter
+    def dirty(self, dirty):
+        self.shown_frames = None if dirty else self.profiler.frames // self.every
+
+    def render(self, pixels):
+        pixels[self.x:self.x+self.width, self.y:self.y+self.height] = self.color
+        start = 0
+        for i, name in enumerate(list(self.profiler.phases)):
+            end = min(start + int(round(self.width * self.profiler.median(name) / self.budget)), self.width)
+            pixels[self.x+start:self.x+end, self.y:self.y+self.height] = self.shades[i % len(self.shades)]
+            start = end
 
 class Glyph(Rectangle):
 
@@ -191,15 +247,25 @@ class Glyph(Rectangle):
 
 class GUIText(Rectangle):
     def __init__(self, x,y, text, scale=1):
-        super().__init__(x,y,(3+2)*len(text),5,1.0)
+        super().__init__(x,y,max(4*len(text)-1, 0)*scale,5*scale,1.0)
         self.characters = []
         for i in range(len(text)):
             self.characters.append(Glyph(x+i*4*scale, y, text[i], scale))
         self.scale = scale
+        # The glyphs are rasterised once. The gaps between them are left
+        # alone when drawing, as they were when each glyph drew itself.
+        self.bitmap = np.zeros((self.width, self.height))
+        self.mask = np.zeros((self.width, self.height), bool)
+        for glyph in self.characters:
+            x0 = glyph.x - x
+            self.bitmap[x0:x0+3*scale] = glyph.scaled_map
+            self.mask[x0:x0+3*scale] = True
 
     def render(self, pixels):
-        for i in range(len(self.characters)):
-            self.characters[i].render(pixels)
+        region = pixels[self.x:self.x+self.width, self.y:self.y+self.height]
+        # Text running off the strip is clipped, as slicing clipped the glyphs
+        width, height = region.shape
+        np.copyto(region, self.bitmap[:width, :height], where=self.mask[:width, :height])
 
 class GUI:
 
@@ -209,6 +275,7 @@ class GUI:
         "birthMin" : 0.6,
         "lifeMin" : 0.5,
         "showFourier" : 0,
+        "turbo" : 1,
     }
     actions = {
         app.window.key.Q: ("deadMin", 0.1),
@@ -222,7 +289,9 @@ class GUI:
         "+" : ("lifeMin", 0.01),
         "ě" : ("lifeMin", -0.01),
         "f" : ("showFourier", 1),
-        "g" : ("showFourier", -1)
+        "g" : ("showFourier", -1),
+        "t" : ("turbo", 1),
+        "r" : ("turbo", -1)
     }
 
     def __init__(self, width, height):
@@ -249,8 +318,15 @@ class GUI:
         print("========================")
 
     def on_draw(self, dt):
+        # Renders the dirty objects, and the ones drawn over them, in order.
+        # Returns whether self.pixels changed.
+        drawn = []
         for o in self.objects:
-            o.render(self.pixels)
+            if getattr(o, "dirty", True) or any(overlaps(o, d) for d in drawn):
+                o.render(self.pixels)
+                o.dirty = False
+                drawn.append(o)
+        return len(drawn) > 0
 
     def on_key_press(self, symbol, modifiers):
         changed = False
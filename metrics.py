@@ -0,0 +1,148 @@
+from collections import deque
+
+import numpy as np
+
+# Metric histories with O(1) appends. Statistics cover the newest `window`
+# samples, the ring buffer itself can hold many more of them for plotting or
+# analysis. A history starts out as `window` samples of `fill`, like the
+# zeroed arrays the engines used to shift.
+
+class MetricHistory:
+    # Every sample is written twice, at i and i+capacity, so the newest n of
+    # them are always one contiguous slice and reading them copies nothing.
+    # shape batches independent histories, e.g. one per ensemble member.
+    def __init__(self, window=100, capacity=None, limits=None, shape=(), fill=0.0):
+        self.window = window
+        self.capacity = max(capacity or window, window)
+        self.limits = limits
+        self.shape = tuple(shape)
+        self.data = np.full((2*self.capacity,) + self.shape, fill, dtype=float)
+        self.head = 0
+        # Samples appended so far, not counting the fill
+        self.samples = 0
+        self.window_sum = np.full(self.shape, fill*window)
+        # Newest samples in a row inside the limits, and steps in a row with
+        # the whole window inside
+        self.inside_run = np.where(self.inside(np.full(self.shape, fill)), window, 0)
+        self.streak = np.zeros(self.shape, dtype=int)
+        # Monotonic deques of (index, value) for the running extremes, the
+        # fill counts as one sample at index -1
+        if not self.shape:
+            self.minima = deque([(-1, fill)])
+            self.maxima = deque([(-1, fill)])
+
+    def inside(self, value):
+        if self.limits is None:
+            return np.zeros(np.shape(value), dtype=bool)
+        bottom_limit, top_limit = self.limits
+        return (bottom_limit < value) & (value < top_limit)
+
+    def append(self, value):
+        value = np.asarray(value, dtype=float)
+        leaving = self.data[self.head+self.capacity-self.window]
+        self.window_sum = self.window_sum + value - leaving
+        self.data[self.head] = value
+        self.data[self.head+self.capacity] = value
+        self.head = (self.head+1) % self.capacity
+
+        inside = self.inside(value)
+        self.inside_run = np.where(inside, self.inside_run+1, 0)
+        self.streak = np.where(self.inside_run >= self.window, self.streak+1, 0)
+
+        if not self.shape:
+            index = self.samples
+            value = float(value)
+            while self.minima and self.minima[-1][1] >= value:
+                self.minima.pop()
+            self.minima.append((index, value))
+            while self.maxima and self.maxima[-1][1] <= value:
+                self.maxima.pop()
+            self.maxima.append((index, value))
+            oldest = index - self.window + 1
+            while self.minima[0][0] < oldest:
+                self.minima.popleft()
+            while self.maxima[0][0] < oldest:
+                self.maxima.popleft()
+        self.samples += 1
+
+    def last(self, n=None):
+        # The newest n samples (default the window), oldest first
+        n = self.window if n is None else min(n, self.capacity)
+        end = self.head + self.capacity
+        return self.data[end-n:end]
+
+    def newest_first(self, n=None):
+        return self.last(n)[::-1]
+
+    @property
+    def latest(self):
+        return self.data[self.head+self.capacity-1]
+
+    @property
+    def in_bounds(self):
+        # Whether the whole window lies strictly inside the limits
+        return self.inside_run >= self.window
+
+    def min(self):
+        if not self.shape:
+            return self.minima[0][1]
+        return self.last().min(axis=0)
+
+    def max(self):
+        if not self.shape:
+            return self.maxima[0][1]
+        return self.last().max(axis=0)
+
+    def mean(self):
+        return self.window_sum / self.window
+
+
+# Steps that are not shown (see Engine.step), e.g. in turbo mode, skip the
+# metrics costing more than this many operations per cell
+hidden_cost_limit = 8
+
+# How each metric is computed. compute(changed, engine) gets the number of
+# cells the step changed, which every metric here derives from. cost is a
+# rough count of operations per cell on top of counting the changed cells;
+# every is the cadence in steps, and displayed metrics are only computed on
+# steps that are shown, like the ones over hidden_cost_limit.
+#
+# A history counts samples, not steps: with every=k, or a metric skipped on
+# hidden steps, its window and win streak span more steps than samples.
+# steps_to_win scales by every, skipped steps are not accounted for, and
+# fast_forward needs every metric sampled on every step.
+class MetricSpec:
+    def __init__(self, compute, cost, every=1, displayed=False):
+        self.compute = compute
+        self.cost = cost
+        self.every = every
+        self.displayed = displayed
+
+    def due(self, step, shown=True):
+        if step % self.every:
+            return False
+        return shown or not (self.displayed or self.cost > hidden_cost_limit)
+
+def log_changed(changed, engine):
+    return np.log(changed+1)/np.log(2)
+
+def changed_count(changed, engine):
+    # gaussian_filter is normalised and reflects at the grid edges, so the
+    # filtered derivative sums to exactly the number of changed cells
+    return changed*1.0
+
+def filtered_sum(changed, engine):
+    # The same sum the long way round, through the full-grid filter. Only
+    # for engines that keep the derivative.
+    return float(np.sum(engine.g_filtered))
+
+# A sigma 6 gaussian reaches 24 cells each way, along both axes
+filtered_sum_cost = 2*49
+
+def default_specs(filtered=False):
+    # filtered computes gaussian_metric through the filter, as a check on
+    # changed_count; hidden steps then skip it
+    return {
+        "derivative_metric": MetricSpec(log_changed, 0),
+        "gaussian_metric": MetricSpec(filtered_sum, filtered_sum_cost) if filtered else MetricSpec(changed_count, 0),
+    }
@@ -0,0 +1,128 @@
+import contextlib
+import json
+import time
+
+import numpy as np
+
+# Timings of the named phases of stepping and rendering. Code that can be
+# profiled holds a profiler and wraps its phases in
+#
+#   with self.profiler.phase("convolution"):
+#       ...
+#
+# The default profiler, `disabled`, hands out one shared do-nothing context,
+# so unprofiled runs pay a method call per phase and nothing else.
+#
+# A Profiler keeps the last `window` durations of every phase and answers
+# percentiles over them. end_frame() closes a rendered frame; with a
+# dump_path it also appends a JSON line of every phase's statistics to that
+# file every dump_interval seconds.
+
+class NullProfiler:
+    enabled = False
+    frames = 0
+    nothing = contextlib.nullcontext()
+
+    def phase(self, name):
+        return self.nothing
+
+    def record(self, name, seconds):
+        pass
+
+    def end_frame(self):
+        pass
+
+disabled = NullProfiler()
+
+
+class Timer:
+    # One per phase name and reused, so a phase must not be timed on two
+    # threads at once (the stepping thread of runner.py and the render loop
+    # time different phases)
+    def __init__(self, profiler, name):
+        self.profiler = profiler
+        self.name = name
+        self.start = 0.0
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.profiler.record(self.name, time.perf_counter() - self.start)
+
+
+class PhaseTimes:
+    # Ring buffer of the last `window` durations of a phase
+    def __init__(self, window):
+        self.times = np.zeros(window)
+        self.count = 0
+        self.total = 0.0
+
+    def append(self, seconds):
+        self.times[self.count % len(self.times)] = seconds
+        self.count += 1
+        self.total += seconds
+
+    def last(self):
+        return self.times[:min(self.count, len(self.times))]
+
+
+class Profiler:
+    enabled = True
+
+    def __init__(self, window=256, dump_path=None, dump_interval=5.0):
+        self.window = window
+        self.phases = {}
+        self.timers = {}
+        self.frames = 0
+        self.dump_path = dump_path
+        self.dump_interval = dump_interval
+        self.last_dump = time.perf_counter()
+
+    def phase(self, name):
+        timer = self.timers.get(name)
+        if timer is None:
+            timer = self.timers[name] = Timer(self, name)
+        return timer
+
+    def record(self, name, seconds):
+        times = self.phases.get(name)
+        if times is None:
+            times = self.phases[name] = PhaseTimes(self.window)
+        times.append(seconds)
+
+    def end_frame(self):
+        self.frames += 1
+        if self.dump_path is not None and time.perf_counter() - self.last_dump >= self.dump_interval:
+            self.dump()
+
+    # Queries, in seconds over the last `window` samples of a phase
+
+    def percentile(self, name, q):
+        times = self.phases[name].last()
+        return float(np.percentile(times, q)) if len(times) else 0.0
+
+    def median(self, name):
+        return self.percentile(name, 50)
+
+    def stats(self):
+        # Every phase's count and percentiles in milliseconds, in the order
+        # the phases were first seen. The stepping thread may add a phase
+        # meanwhile, so this goes over a copy.
+        stats = {}
+        for name, times in list(self.phases.items()):
+            last = times.last()
+            if not len(last):
+                continue
+            p50, p90, p99 = np.percentile(last, [50, 90, 99]) * 1000
+            stats[name] = {"count": times.count, "total_s": times.total, "p50_ms": p50, "p90_ms": p90,
+                           "p99_ms": p99, "max_ms": float(last.max()) * 1000}
+        return stats
+
+    def dump(self, path=None):
+        # Appends a JSON line to path, default dump_path
+        self.last_dump = time.perf_counter()
+        line = json.dumps({"time": time.time(), "frames": self.frames, "phases": self.stats()})
+        with open(path or self.dump_path, "a") as file:
+            file.write(line + "\n")
@@ -0,0 +1,154 @@
+import json
+import queue
+import threading
+import zlib
+
+import numpy as np
+from engine import pack_cells, unpack_cells
+
+# Recorded runs. A file is
+#
+#   magic, header length (u4), JSON header
+#   one zlib compressed chunk per frame
+#   index: one entry per frame (see index_dtype), then trailer_dtype
+#
+# Frames are the cells packed to bits. Every keyframe_interval-th frame is a
+# keyframe stored as it is, the others as their XOR with the keyframe before
+# them, so seeking to any frame decompresses at most two chunks. The index
+# also carries each frame's step and latest metric values.
+
+magic = b"CELLREC1"
+trailer_magic = b"CELLIDX1"
+trailer_dtype = np.dtype([("index_offset", "<u8"), ("frames", "<u8"), ("magic", "S8")])
+
+def index_dtype(metric_names):
+    return np.dtype([("offset", "<u8"), ("length", "<u4"), ("keyframe", "<i8"), ("step", "<i8")] +
+                    [(name, "<f8") for name in metric_names])
+
+
+class Recorder:
+    # Packing happens in record(), everything else (delta encoding,
+    # compression, writing) on a writer thread, so recording only waits for
+    # the disk when the writer falls max_pending frames behind. Every frame
+    # is kept, a full queue blocks record() rather than dropping any, and
+    # holds at most max_pending packed frames (width*height/8 bytes each).
+    # close() writes the index.
+    def __init__(self, path, width, height, metric_names=(), keyframe_interval=64, level=1, max_pending=8):
+        self.width = width
+        self.height = height
+        self.metric_names = list(metric_names)
+        self.keyframe_interval = keyframe_interval
+        self.level = level
+        self.file = open(path, "wb")
+        header = json.dumps({"width": width, "height": height, "keyframe_interval": keyframe_interval,
+                             "metrics": self.metric_names}).encode()
+        self.file.write(magic + np.uint32(len(header)).tobytes() + header)
+        self.index = []
+        self.queue = queue.Queue(maxsize=max_pending)
+        self.writer = threading.Thread(target=self.write_frames, daemon=True)
+        self.writer.start()
+
+    def record(self, cells, step, metrics=None, packed=False):
+        # cells is a grid, or already packed with pack_cells if packed
+        metrics = metrics or {}
+        values = tuple(float(metrics.get(name, np.nan)) for name in self.metric_names)
+        if packed:
+            # The writer gets a copy, the caller may reuse its array
+            cells = np.array(cells)
+        else:
+            cells = np.asarray(cells)
+            cells = pack_cells(cells if cells.dtype == bool else cells > 0.5)
+        self.queue.put((cells, step, values))
+
+    def record_engine(self, engine):
+        metrics = {name: history.latest for name, history in engine.metrics.items()}
+        if getattr(engine, "storage", None) == "packed":
+            self.record(engine.state, engine.steps, metrics, packed=True)
+        else:
+            self.record(engine.simulation_cells, engine.steps, metrics)
+
+    def write_frames(self):
+        keyframe = None
+        while True:
+            item = self.queue.get()
+            if item is None:
+                break
+            packed, step, values = item
+            number = len(self.index)
+            if number % self.keyframe_interval == 0:
+                keyframe, keyframe_number, data = packed, number, packed
+            else:
+                data = np.bitwise_xor(packed, keyframe)
+            chunk = zlib.compress(data.tobytes(), self.level)
+            self.index.append((self.file.tell(), len(chunk), keyframe_number, step) + values)
+            self.file.write(chunk)
+
+    def close(self):
+        if self.file is None:
+            return
+        self.queue.put(None)
+        self.writer.join()
+        index = np.array(self.index, dtype=index_dtype(self.metric_names))
+        trailer = np.array([(self.file.tell(), len(index), trailer_magic)], dtype=trailer_dtype)
+        self.file.write(index.tobytes())
+        self.file.write(trailer.tobytes())
+        self.file.close()
+        self.file = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class Replay:
+    # Random access to the frames of a recording, read through a memory map
+    def __init__(self, path):
+        self.data = np.memmap(path, dtype=np.uint8, mode="r")
+        if bytes(self.data[:len(magic)]) != magic:
+            raise ValueError("%s is not a recording" % path)
+        start = len(magic) + 4
+        header_length = int(self.data[len(magic):start].view("<u4")[0])
+        header = json.loads(bytes(self.data[start:start+header_length]))
+        self.width = header["width"]
+        self.height = header["height"]
+        self.keyframe_interval = header["keyframe_interval"]
+        self.metric_names = header["metrics"]
+        trailer = self.data[len(self.data)-trailer_dtype.itemsize:].view(trailer_dtype)[0]
+        if trailer["magic"] != trailer_magic:
+            raise ValueError("%s has no index, was the recorder closed?" % path)
+        dtype = index_dtype(self.metric_names)
+        offset = int(trailer["index_offset"])
+        self.index = self.data[offset:offset+int(trailer["frames"])*dtype.itemsize].view(dtype)
+        self.steps = self.index["step"]
+        self.metrics = {name: self.index[name] for name in self.metric_names}
+        # The last keyframe decoded, consecutive frames share it
+        self.keyframe_number = None
+        self.keyframe = None
+
+    def __len__(self):
+        return len(self.index)
+
+    def chunk(self, number):
+        entry = self.index[number]
+        offset = int(entry["offset"])
+        packed = np.frombuffer(zlib.decompress(self.data[offset:offset+int(entry["length"])]), dtype=np.uint8)
+        return packed.reshape(self.width, -1)
+
+    def packed_frame(self, number):
+        keyframe_number = int(self.index[number]["keyframe"])
+        if keyframe_number != self.keyframe_number:
+            self.keyframe = self.chunk(keyframe_number)
+            self.keyframe_number = keyframe_number
+        if number == keyframe_number:
+            return self.keyframe
+        return np.bitwise_xor(self.chunk(number), self.keyframe)
+
+    def frame(self, number):
+        # The cells of a frame as a boolean mask
+        return unpack_cells(self.packed_frame(number), self.height)
+
+    def close(self):
+        self.index = self.steps = self.metrics = None
+        self.data = None
@@ -0,0 +1,92 @@
+import queue
+import threading
+
+import numpy as np
+
+# Steps a simulation on its own thread, decoupled from the render loop. The
+# stepping thread renders each shown frame into the back buffer of a triple
+# buffer and publishes it; the renderer only ever picks up the newest
+# completed frame and never waits for a step. numpy releases the GIL in the
+# transforms and ufuncs, so stepping and drawing overlap.
+#
+# With turbo k the thread runs k steps per published frame, and only the
+# last of them computes the view and the metrics declared displayed.
+
+def to_frame(view, out):
+    # Integer frames hold the view scaled to their full range, e.g. uint8
+    # textures, which the GPU reads back normalised to [0, 1]
+    if out.dtype.kind in "ui":
+        np.multiply(view, np.iinfo(out.dtype).max, out=out, casting="unsafe")
+    else:
+        np.copyto(out, view, casting="unsafe")
+    return out
+
+class TripleBuffer:
+    # array_type lets the reader get the frames as e.g. textures sharing the
+    # buffers' memory, so what the writer renders is uploaded without a copy
+    def __init__(self, shape, dtype, array_type=np.ndarray):
+        self.buffers = [np.zeros(shape, dtype) for _ in range(3)]
+        self.views = [buffer.view(array_type) for buffer in self.buffers]
+        # Counts published frames, a reader seeing the same version twice
+        # got no new frame
+        self.version = 0
+        # Indices of the buffer being written, the newest published one and
+        # the one the reader holds
+        self.back, self.ready, self.front = 0, 1, 2
+        self.fresh = False
+        self.lock = threading.Lock()
+
+    def back_buffer(self):
+        return self.buffers[self.back]
+
+    def publish(self):
+        with self.lock:
+            self.back, self.ready = self.ready, self.back
+            self.fresh = True
+            self.version += 1
+
+    def read(self):
+        # The newest published frame, or the last one read if nothing new
+        # was published since
+        with self.lock:
+            if self.fresh:
+                self.front, self.ready = self.ready, self.front
+                self.fresh = False
+            return self.views[self.front]
+
+
+class SimulationThread(threading.Thread):
+    # simulation needs an engine, a viewport and a view() returning the
+    # frame to show, the viewport's size
+    def __init__(self, simulation, turbo=1, dtype=float, array_type=np.ndarray):
+        super().__init__(daemon=True)
+        self.simulation = simulation
+        self.engine = simulation.engine
+        self.turbo = turbo
+        shape = simulation.viewport.display_shape
+        self.frames = TripleBuffer(shape, dtype, array_type)
+        # Painting from the input handlers is queued and applied between
+        # steps, so it never races with a step
+        self.paints = queue.SimpleQueue()
+        self.stopped = threading.Event()
+
+    def paint(self, x, y, value):
+        self.paints.put((x, y, value))
+
+    def run(self):
+        engine = self.engine
+        while not self.stopped.is_set():
+            while not self.paints.empty():
+                engine.paint(*self.paints.get())
+            turbo = max(1, int(self.turbo))
+            engine.step(turbo-1, shown=False)
+            engine.step()
+            view = self.simulation.view()
+            with engine.profiler.phase("frame"):
+                to_frame(view, self.frames.back_buffer())
+            self.frames.publish()
+
+    def stop(self):
+        self.stopped.set()
+        if self.is_alive():
+            self.join()
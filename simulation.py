@@ -1,179 +1,133 @@
 import numpy as np
-import scipy
-from scipy.ndimage import gaussian_filter
+from engine import Engine, view, win_limits
 from gui import Graph, GUIText
-
-class Kernel:
-    def __init__(self, values, cells_shape):
-        self.shape = values.shape
-        self.size = values.shape[0]
-        self.values = values
-
-        self.cells_shape = cells_shape
-        self.update_fft()
-
-    def update_fft(self):
-        self.fft = np.fft.rfft2(self.values, self.cells_shape)
-
+from metrics import MetricHistory
+from recording import Replay
+from runner import SimulationThread
+from viewport import Viewport
+
+def add_graphs(GUI, source, win_limits):
+    # Graphs of source.metrics, with the win limits drawn in
+    bottom_limit, top_limit = win_limits["derivative_metric"]
+    GUI.objects.append(Graph(280, 0, 60, "derivative_metric", source, top_limit=top_limit, bottom_limit=bottom_limit))
+    bottom_limit, top_limit = win_limits["gaussian_metric"]
+    GUI.objects.append(Graph(410, 0, 60, "gaussian_metric", source, top_limit=top_limit, bottom_limit=bottom_limit))
 
 class Simulation:
     averaging = False
-    metricPoints = 100
+    metricPoints = Engine.metricPoints
 
     brush_size = 5
 
-    def __init__(self, width, height, GUI):
+    def __init__(self, width, height, GUI, display_shape=None, reduce="max"):
         self.width = width
         self.height = height
         self.GUI = GUI
-
-        self.derivative_metric = np.zeros(self.metricPoints)
-        self.gaussian_metric = np.zeros(self.metricPoints)
-        GUI.objects.append(Graph(280, 0, 60, "derivative_metric", self, top_limit=17, bottom_limit=11))
-        GUI.objects.append(Graph(410, 0, 60, "gaussian_metric", self, top_limit=14000, bottom_limit=6000))
-        # GUI.objects.append(Graph(280, 0, 60, "derivative_metric", self, top_limit=20, bottom_limit=0))
-        # GUI.objects.append(Graph(410, 0, 60, "gaussian_metric", self, top_limit=20000, bottom_limit=0))
-        self.win_condition = {}
-        self.win_condition["derivative_metric"] = False
-        self.win_condition["gaussian_metric"] = False
+        # What of the grid is shown, display_shape pixels of it
+        self.viewport = Viewport((width, height), display_shape or (width, height), reduce)
+
+        # GUI.values is shared with the engine, so sliders act on the next step
+        self.engine = Engine(width, height, values=GUI.values)
+        self.gaussian_kernel = self.engine.kernels["gaussian"]
+        self.circle_kernel = self.engine.kernels["circle"]
+        self.kernel = self.engine.kernels["checkerboard"]
+
+        add_graphs(GUI, self.engine, self.engine.win_limits)
+        # GUI.objects.append(Graph(280, 0, 60, "derivative_metric", self.engine, top_limit=20, bottom_limit=0))
+        # GUI.objects.append(Graph(410, 0, 60, "gaussian_metric", self.engine, top_limit=20000, bottom_limit=0))
         self.won = False
 
-        self.cells = np.zeros((self.width, self.height))
-        self.simulation_cells = (np.random.uniform(0, 1, (self.width, self.height)) > 0.5).astype(np.float)
-        self.new_cells = np.zeros_like(self.cells)
-
-        # gaussian kernel
-        self.gaussian_kernel_size = 33
-        mu = self.gaussian_kernel_size // 2
-        sigma = 30
-        self.gaussian_kernel = np.fromfunction(lambda x, y: np.exp(-(x-mu)**2 / sigma - (y-mu)**2 / sigma), (self.gaussian_kernel_size, self.gaussian_kernel_size))
-        self.gaussian_kernel = Kernel(self.gaussian_kernel/np.max(self.gaussian_kernel), self.cells.shape)
-
-        # circle kernel
-        self.circle_kernel_size = 33
-        center = self.circle_kernel_size // 2
-        radius = 2
-        sigma = 2
-        def circle_fn(x,y):
-            dist = np.sqrt((x-center)**2 + (y-center)**2)
-            return np.exp(-(dist-radius)**2 / sigma)
-        self.circle_kernel = np.fromfunction(circle_fn, (self.circle_kernel_size, self.circle_kernel_size))
-        self.circle_kernel = Kernel(self.circle_kernel/np.max(self.circle_kernel), self.cells.shape)
-
-        # checkerboard kernel
-        self.kernel_size = 16
-        half_size = self.kernel_size//2
-        self.kernel = np.zeros((self.kernel_size, self.kernel_size))
-        self.kernel[:half_size, :half_size] = 1.0
-        self.kernel[half_size:, half_size:] = 1.0
-
-        self.kernel = Kernel(gaussian_filter(self.kernel, 0.1), self.cells.shape)
+        self.cells = np.zeros(self.viewport.display_shape)
+        self.average = np.zeros((self.width, self.height))
+        # Set by start(), steps the engine off the render loop
+        self.runner = None
+
+    def start(self, dtype=float, array_type=np.ndarray):
+        # dtype and array_type of the published frames, see runner.py
+        self.runner = SimulationThread(self, self.GUI.values["turbo"], dtype, array_type)
+        self.runner.start()
+
+    def stop(self):
+        if self.runner is not None:
+            self.runner.stop()
+            self.runner = None
 
     def on_draw_random(self, dt):
         rnd = np.random.uniform(0, 1, (self.width, self.height))
         self.cells = rnd
 
     def on_mouse_drag(self, x, y, dx, dy, button):
-        x = int(x*self.width)
-        y = int(y*self.height)
-        size = self.brush_size
-        self.simulation_cells[x-size:x+size, y-size:y+size] = 1.0
+        # x and y are relative to the display, the brush keeps its size on
+        # screen at any zoom
+        width, height = self.viewport.display_shape
+        x, y = self.viewport.to_grid(x*width, y*height)
+        size = max(1, int(round(self.brush_size/self.viewport.zoom)))
+        target = self.runner if self.runner is not None else self.engine
+        target.paint(slice(x-size, x+size), slice(y-size, y+size), 1.0)
         # self.cells = np.clip(self.cells, 0, 1)
 
-    def fast_conv2d(self, cells, kernel):
-        conv_cells = np.fft.irfft2(np.fft.rfft2(cells) * kernel.fft)
+    def on_draw(self, dt):
+        engine = self.engine
+        # Turbo runs several steps per shown frame, the hidden ones skip the
+        # view and the metrics declared displayed
+        turbo = max(1, int(self.GUI.values["turbo"]))
+        if self.runner is not None:
+            self.runner.turbo = turbo
+            self.cells = self.runner.frames.read()
+        else:
+            engine.step(turbo-1, shown=False)
+            engine.step()
+            self.cells = self.view()
+
+        if engine.won and not self.won:
+            self.GUI.objects.append(GUIText(200, 70, "you won, congratulations", 3))
+            self.won = True
 
-        conv_cells = np.roll(conv_cells, -kernel.size//2+1, 0)
-        conv_cells = np.roll(conv_cells, -kernel.size//2+1, 1)
+        # debug view na kernel konvoluce
+        # self.cells[:self.kernel.size, :self.kernel.size] = self.kernel.values
 
-        return conv_cells
+    def view(self):
+        # The frame shown for the engine's current step, as the viewport
+        # shows it
+        engine = self.engine
+        mode = self.GUI.values["showFourier"]
+        if self.averaging:
+            self.average = 0.3*engine.simulation_cells+0.7*self.average
+            return self.viewport.render(self.average, (engine.steps, "average"))
+        return self.viewport.render(view(engine, mode), (engine.steps, mode))
+
+
+class ReplaySimulation:
+    # Plays a recording (see recording.py) back through the same drawing
+    # path, without stepping anything. Turbo skips frames, dragging across
+    # the grid seeks.
+    def __init__(self, path, GUI, display_shape=None, reduce="max"):
+        self.replay = Replay(path)
+        self.width = self.replay.width
+        self.height = self.replay.height
+        self.GUI = GUI
+        self.viewport = Viewport((self.width, self.height), display_shape or (self.width, self.height), reduce)
+        self.position = 0
+        self.metrics = {name: MetricHistory(Engine.metricPoints) for name in self.replay.metric_names}
+        add_graphs(GUI, self, win_limits)
+        self.cells = np.zeros(self.viewport.display_shape)
+        self.runner = None
+
+    def show(self, number):
+        self.cells = self.viewport.render(self.replay.frame(number), number)
+        # The graphs show the window of samples up to this frame
+        for name, history in self.metrics.items():
+            samples = self.replay.metrics[name][max(0, number+1-history.window):number+1]
+            for value in np.concatenate([np.zeros(history.window - len(samples)), samples]):
+                history.append(value)
 
     def on_draw(self, dt):
-        # random example
-        # rnd = np.random.uniform(0, 1, (cwidth, cheight))
-        # rnd = np.repeat(np.expand_dims(rnd, -1), 4, -1)
-        # rnd[:, :, 0] = 0
-        # render["texture"] = rnd
-        # render["texture"][:, :, 0] = rnd
-
-        # game of life wat version
-        # print(render["texture"].shape)
-        # old_cells = render["texture"][:, :, 0]
-        # for x, row in enumerate(old_cells):
-        #     for y, cell in enumerate(row):
-        #         suma = np.sum(old_cells[x-2:x+1, y-2:y+1]) - cell
-        #         # old_cells[x, y] = 0.5
-        #         if suma < 2 or suma > 3:
-        #             new_cells[x, y] = 0
-        #         else:
-        #             new_cells[x, y] = 1
-
-        # neighbours_filter = np.array([[1,1,1], [1,0,1], [1,1,1]])
-        # self.new_cells = scipy.signal.convolve2d(self.cells, self.kernel, "same", "wrap")
-
-        gaussian_cells = self.fast_conv2d(self.simulation_cells, self.gaussian_kernel)
-        circle_cells = self.fast_conv2d(self.simulation_cells, self.circle_kernel)
-        checkerboard_cells = self.fast_conv2d(self.simulation_cells, self.kernel)
-
-        # new_cells = new_cells[1:, 1:]
-        # new_cells = np.pad(new_cells, [(1, 0), (1, 0)])
-        # new_cells = new_cells[1:-1, 1:-1]
-        # new_cells = scipy.signal.fftconvolve(old_cells, self.kernel, mode='same')
-
-        # new_cells[:decay_size, :decay_size] = self.kernel
-        # weird
-        # self.new_cells -= (circle_cells/np.sum(self.circle_kernel) > 0.8).astype(float)
-        # self.new_cells += (circle_cells/np.sum(self.circle_kernel) < 0.2).astype(float)
-        # self.new_cells += (self.new_cells - gaussian_cells/np.sum(self.gaussian_kernel))*0.1
-
-        # self.new_cells = self.cells
-        # self.new_cells += (1-((gaussian_cells > 0.1) & (gaussian_cells < 0.3) & (circle_cells > 0.1) & (circle_cells < 0.3)).astype(float))*0.1
-        # self.new_cells += (-((gaussian_cells < 0.1) | (gaussian_cells > 0.3)).astype(float))*0.1
-
-        # self.new_cells = ((self.new_cells < 3.1) & (self.new_cells > 2.5)).astype(float)
-        # new_cells[:decay_size, :decay_size] = self.distance_exp_decay
-        # self.new_cells /= np.sum(self.distance_exp_decay)
-        #
-        # self.new_cells= 4*self.new_cells*(1-self.new_cells)
-        # print(self.new_cells.max(), self.new_cells.min(), np.mean(self.new_cells))
-
-        # self.new_cells = self.cells + (self.new_cells - self.cells)*0.1
-        # new_cells /= np.max(new_cells)
-        # new_cells = ((new_cells >= 2) & (new_cells <= 3) & (old_cells == 1)) | ((new_cells == 3) & (old_cells==0))
-        # new_cells = new_cells.astype(float)
-        self.new_cells = checkerboard_cells/np.sum(self.kernel.values)
-
-        self.new_cells = ((self.new_cells < self.GUI.values["popMax"]) & ((self.new_cells > (1-self.GUI.values["birthMin"])) | ((self.new_cells > self.GUI.values["deadMin"]) & (self.simulation_cells > self.GUI.values["lifeMin"])))).astype(float)
-
-        # Determines the derivative
-        derivative = np.absolute(self.new_cells - self.simulation_cells)
-        derivative_sum = np.log(np.sum(derivative)+1)/np.log(2)
-        # fourierSum = np.sum(self.new_cells[3*self.width//4:][3*self.height//4:])
-        g_filtered = gaussian_filter(derivative, 6)
-        gaussian_sum = np.sum(g_filtered)
-        self.derivative_metric = np.roll(self.derivative_metric, 1)
-        self.gaussian_metric = np.roll(self.gaussian_metric, 1)
-        self.derivative_metric[0] = derivative_sum
-        self.gaussian_metric[0] = gaussian_sum
-        # print(derivative_sum, gaussian_sum, gaussian_sq_sum)
-        # Update metrics
-        # self.new_cells = np.exp(-(self.new_cells - 0.5 + 0.2*self.simulation_cells) ** 2/(0.1+0.2*self.simulation_cells))
-        if(self.win_condition["derivative_metric"] and self.win_condition["gaussian_metric"] and not self.won):
-            self.GUI.objects.append(GUIText(200, 70, "you won, congratulations", 3))
-        if self.averaging:
-            self.cells = 0.3*self.simulation_cells+0.7*self.cells
-        else:
-            self.cells = self.simulation_cells
-            if self.GUI.values["showFourier"] == 1:
-                fourier = np.absolute(np.fft.fft2(self.new_cells))
-                fourier = np.log(fourier+1)
-                fourier = fourier / fourier.max()
-                self.cells = fourier
-            if self.GUI.values["showFourier"] == 2:
-                self.cells = derivative
-            if self.GUI.values["showFourier"] == 3:
-                self.cells = g_filtered
-        self.simulation_cells, self.new_cells = self.new_cells, self.simulation_cells
+        self.show(self.position)
+        turbo = max(1, int(self.GUI.values["turbo"]))
+        self.position = (self.position + turbo) % len(self.replay)
 
-        # debug view na kernel konvoluce
-        # self.cells[:self.kernel_size, :self.kernel_size] = self.kernel
+    def on_mouse_drag(self, x, y, dx, dy, button):
+        self.position = min(max(int(x*len(self.replay)), 0), len(self.replay)-1)
+
+    def stop(self):
+        self.replay.close()
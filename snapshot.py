@@ -0,0 +1,135 @@
+import json
+from collections import deque
+
+import numpy as np
+from convolution import Kernel
+from engine import Engine
+
+# The whole state of an Engine in one file: a JSON header followed by raw,
+# aligned arrays. Loading maps the file copy-on-write and hands the engine
+# views of it, so a restored grid is neither parsed nor copied, and the
+# kernel spectra are not transformed again. Writing to a restored engine
+# only copies the pages it touches, and never changes the file.
+#
+#   engine = snapshot.load("warm.snap")
+#
+# The metric specs are code and not saved; pass them to load() again if the
+# engine did not use the default ones.
+
+magic = b"CELLSNAP"
+alignment = 64
+
+def save(path, engine):
+    arrays = {"cells": engine.state, "derivative": engine.derivative}
+    kernels = {}
+    for name, kernel in engine.kernels.items():
+        if kernel.stale:
+            kernel.update_fft()
+        arrays["kernel values " + name] = kernel.values
+        # Only kernels convolved through the FFT have a spectrum to keep
+        spectrum = next(iter(kernel.spectra.values()), None)
+        if spectrum is not None:
+            arrays["kernel fft " + name] = spectrum
+        kernels[name] = [[list(shape), str(cells_dtype), str(dtype), backend]
+                         for (shape, cells_dtype, dtype), backend in kernel.backends.items()]
+    metrics = {}
+    for name, history in engine.metrics.items():
+        arrays["metric " + name] = history.data
+        metrics[name] = {"capacity": history.capacity, "head": history.head, "samples": history.samples,
+                         "window_sum": float(history.window_sum), "inside_run": int(history.inside_run),
+                         "streak": int(history.streak), "minima": list(history.minima), "maxima": list(history.maxima)}
+    if engine.history:
+        arrays["history"] = np.stack(engine.history)
+    # The cycle detector starts over, its hashes are tied to the rule as
+    # this process saw it
+    cycles = None
+    if engine.cycles is not None:
+        cycles = {"capacity": engine.cycles.capacity}
+
+    header = {
+        "width": engine.width, "height": engine.height, "dtype": str(engine.dtype), "storage": engine.storage,
+        "rule_kernel": engine.rule_kernel, "values": engine.values,
+        "win_limits": engine.win_limits, "won": bool(engine.won), "frozen": bool(engine.frozen),
+        "steps": engine.steps, "derivative_step": engine.derivative_step,
+        "history_length": engine.history.maxlen, "tile_size": engine.tile_size,
+        "cycles": cycles, "cycle_period": engine.cycle_period,
+        "rng": engine.rng.bit_generator.state, "kernels": kernels, "metrics": metrics,
+        "arrays": {},
+    }
+    # Offsets are laid out before the header is written, and the header is
+    # padded to a fixed size so they do not move
+    offset = 0
+    for name, array in arrays.items():
+        header["arrays"][name] = {"offset": offset, "shape": list(array.shape), "dtype": array.dtype.str}
+        offset += -(-array.nbytes // alignment) * alignment
+    text = json.dumps(header).encode()
+    start = -(-(len(magic) + 8 + len(text)) // alignment) * alignment
+    with open(path, "wb") as file:
+        file.write(magic + np.uint64(start).tobytes() + text)
+        file.write(bytes(start - file.tell()))
+        for name, array in arrays.items():
+            file.seek(start + header["arrays"][name]["offset"])
+            file.write(np.ascontiguousarray(array).tobytes())
+        file.truncate(start + offset)
+
+def load(path, values=None, metric_specs=None):
+    # values, if given, are the rule's values from now on, e.g. a GUI's
+    # values dict or a sweep's parameters; it is kept by the engine and only
+    # gets the snapshot's values for the keys it lacks
+    data = np.memmap(path, dtype=np.uint8, mode="c")
+    if bytes(data[:len(magic)]) != magic:
+        raise ValueError("%s is not a snapshot" % path)
+    start = int(data[len(magic):len(magic)+8].view("<u8")[0])
+    header = json.loads(bytes(data[len(magic)+8:start]).rstrip(b"\0"))
+    def array(name):
+        entry = header["arrays"][name]
+        return np.ndarray(entry["shape"], entry["dtype"], buffer=data, offset=start + entry["offset"])
+
+    shape = (header["width"], header["height"])
+    kernels = {}
+    for name, backends in header["kernels"].items():
+        fft = array("kernel fft " + name) if "kernel fft " + name in header["arrays"] else None
+        kernel = Kernel(array("kernel values " + name), shape, fft=fft)
+        for cells_shape, cells_dtype, dtype, backend in backends:
+            kernel.backends[tuple(cells_shape), np.dtype(cells_dtype), np.dtype(dtype)] = backend
+        kernels[name] = kernel
+    if values is None:
+        values = {}
+    for key, value in header["values"].items():
+        values.setdefault(key, value)
+    metric_capacity = max([entry["capacity"] for entry in header["metrics"].values()], default=None)
+    cycles = header["cycles"]
+    cells = array("cells")
+    storage = header["storage"]
+    engine = Engine(header["width"], header["height"], values=values, kernels=kernels, rule_kernel=header["rule_kernel"],
+                    cells=np.zeros(shape, bool), win_limits={name: tuple(limits) for name, limits in header["win_limits"].items()},
+                    dtype=header["dtype"], storage=storage, history_length=header["history_length"],
+                    metric_capacity=metric_capacity, metric_specs=metric_specs, tile_size=header["tile_size"],
+                    cycle_capacity=cycles["capacity"] if cycles else 0)
+
+    # The engine's buffers become views of the file
+    if storage == "packed":
+        engine.state = cells
+    else:
+        engine.state = engine.workspace.buffers["state"] = cells
+    engine.derivative = engine.workspace.buffers["derivative"] = array("derivative")
+    for name, entry in header["metrics"].items():
+        history = engine.metrics[name]
+        history.data = array("metric " + name)
+        history.head = entry["head"]
+        history.samples = entry["samples"]
+        history.window_sum = np.float64(entry["window_sum"])
+        history.inside_run = np.int64(entry["inside_run"])
+        history.streak = np.int64(entry["streak"])
+        history.minima = deque(tuple(pair) for pair in entry["minima"])
+        history.maxima = deque(tuple(pair) for pair in entry["maxima"])
+    if "history" in header["arrays"]:
+        engine.history.extend(array("history"))
+    engine.cycle_period = header["cycle_period"]
+    engine.rng.bit_generator.state = header["rng"]
+    engine.steps = header["steps"]
+    engine.derivative_step = header["derivative_step"]
+    engine.update_win_condition()
+    engine.won = header["won"]
+    engine.frozen = header["frozen"]
+    return engine
@@ -0,0 +1,49 @@
+import numpy as np
+from scipy import ndimage
+from convolution import box_conv2d, direct_conv2d, kernel_radius, separable_conv2d, summed_area_table
+
+# Activity driven stepping. A cell can only change if something within the
+# kernel's reach changed in the previous step (with the same rule values and
+# kernel), so the grid is cut into square tiles and only the tiles near last
+# step's changes are recomputed; every other tile carries over as it is.
+#
+# Recomputed tiles are convolved as a batch of small patches, each tile plus
+# a wrapped halo of the kernel's reach, and the "valid" part of each patch
+# convolution is the tile's density. The patches go through the same exact
+# backend as the full grid (see convolution.exact_backends), so a cell's
+# density, and a rule threshold it ties with, comes out the same either way.
+
+# Above this fraction of active tiles the full grid path is cheaper
+activity_limit = 0.25
+
+def active_tiles(derivative, tile, kernel):
+    # Tiles with a changed cell within the kernel's reach, as a boolean grid
+    # of tiles
+    width, height = derivative.shape
+    changed = derivative.reshape(width//tile, tile, height//tile, tile).any(axis=(1, 3))
+    reach = -(-kernel_radius(kernel)//tile)
+    return ndimage.maximum_filter(changed, size=2*reach+1, mode="wrap")
+
+def tile_patches(cells, ix, iy, tile, kernel):
+    # Every tile (ix, iy) with the cells the kernel reaches from it, with the
+    # kernel centred as in convolution.py
+    width, height = cells.shape
+    offset = -(-kernel.size//2+1)
+    span = np.arange(offset-kernel.size+1, tile+offset)
+    rows = (ix[:, None]*tile + span) % width
+    columns = (iy[:, None]*tile + span) % height
+    return cells[rows[:, :, None], columns[:, None, :]]
+
+def tile_density(cells, ix, iy, tile, kernel, backend, dtype=float):
+    patches = tile_patches(cells, ix, iy, tile, kernel)
+    # Where each tile starts in its patch
+    start = kernel.size-1 - -(-kernel.size//2+1)
+    if backend == "box":
+        # The patch table needs no wrapping, the patch is the halo
+        table = summed_area_table(patches, 0)
+        density = box_conv2d(table, start, kernel, (tile, tile), dtype)
+    else:
+        convolve = separable_conv2d if backend == "separable" else direct_conv2d
+        density = convolve(patches, kernel, dtype)[:, start:start+tile, start:start+tile]
+    density /= float(np.sum(kernel.values))
+    return density
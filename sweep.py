@@ -0,0 +1,137 @@
+import argparse
+import csv
+import itertools
+import os
+import sys
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import numpy as np
+import snapshot
+from cycles import CycleDetector
+from engine import Engine, default_values, kernel_builders, storages
+
+# Headless parameter sweep over the win condition.
+#
+#   python sweep.py --deadMin 0.05:0.4:8 --popMax 0.3:0.8:6 --kernels checkerboard,circle -o sweep.csv
+#
+# Every "start:stop:count" range is spread as a grid, or sampled uniformly
+# with --samples. Rows are written as runs finish. With --snapshot every run
+# forks from a state saved by snapshot.py instead of a random one, and gets
+# --steps more steps, counted from the fork.
+
+fields = ["deadMin", "popMax", "birthMin", "lifeMin", "kernel", "seed", "won", "stop", "steps", "period", "derivative_metric", "gaussian_metric"]
+
+def parse_range(text):
+    parts = [float(p) for p in text.split(":")]
+    if len(parts) == 1:
+        return parts[0], parts[0], 1
+    start, stop, count = parts
+    return start, stop, int(count)
+
+def make_runs(ranges, kernels, seeds, samples, rng):
+    if samples:
+        for _ in range(samples):
+            values = {key: rng.uniform(start, stop) for key, (start, stop, count) in ranges.items()}
+            yield dict(values, kernel=str(rng.choice(kernels)), seed=int(rng.integers(seeds)))
+        return
+    axes = [np.linspace(start, stop, count) for start, stop, count in ranges.values()]
+    for point in itertools.product(*axes, kernels, range(seeds)):
+        values = dict(zip(ranges, (float(v) for v in point[:-2])))
+        yield dict(values, kernel=point[-2], seed=point[-1])
+
+def run(params, size, max_steps, options, cycles="forward", warm=None):
+    # cycles: what to do once the cells repeat, "stop" the run, "forward"
+    # skip ahead to where its outcome is known, or "off" not to look
+    values = {key: params[key] for key in default_values}
+    cycle_capacity = 0 if cycles == "off" else 256
+    # The metrics keep as many samples as the longest period the detector
+    # finds, so fast_forward can repeat it
+    metric_capacity = max(Engine.metricPoints, cycle_capacity)
+    if warm:
+        # The snapshot brings its own grid, storage and tiling, the run its
+        # rule; the seed only reseeds the generator. The metrics, and with
+        # them the win streak, were earned under the snapshot's rule, so the
+        # run starts them over.
+        engine = snapshot.load(warm, values=values)
+        engine.rule_kernel = params["kernel"]
+        engine.rng = np.random.default_rng(params["seed"])
+        capacity = max(history.capacity for history in engine.metrics.values())
+        engine.reset_metrics(max(capacity, metric_capacity), engine.metric_specs)
+        engine.last_rule = None
+        engine.cycles = CycleDetector(cycle_capacity) if cycle_capacity else None
+        engine.cycle_period = None
+    else:
+        engine = Engine(size, size, values=values, rule_kernel=params["kernel"], seed=params["seed"],
+                        cycle_capacity=cycle_capacity, metric_capacity=metric_capacity, **options)
+    # Steps are counted from the fork
+    start = engine.steps
+    max_steps += start
+    stop = "budget"
+    while engine.steps < max_steps:
+        engine.step()
+        if engine.won:
+            stop = "won"
+            break
+        if not engine.can_win(max_steps - engine.steps):
+            stop = "frozen" if engine.frozen else "cycle" if engine.cycle_period else "unwinnable"
+            break
+        if engine.cycle_period:
+            if cycles == "stop":
+                stop = "cycle"
+                break
+            # The cycle can still win, and exactly when the lower bound says.
+            # Otherwise (a metric sampled less often than every step, say)
+            # the run keeps stepping.
+            if engine.fast_forward_blocker() is None:
+                engine.fast_forward(min(engine.steps_to_win(), max_steps - engine.steps))
+                if engine.won:
+                    stop = "won"
+                    break
+    return dict(params, won=engine.won, stop=stop, steps=engine.steps - start, period=engine.cycle_period,
+                derivative_metric=float(engine.metrics["derivative_metric"].latest), gaussian_metric=float(engine.metrics["gaussian_metric"].latest))
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Map the winnable region of the rule parameters")
+    for key, value in default_values.items():
+        parser.add_argument("--" + key, default=str(value), help="value or start:stop:count")
+    parser.add_argument("--kernels", default="checkerboard", help="comma separated, from: " + ", ".join(kernel_builders))
+    parser.add_argument("--seeds", type=int, default=1, help="random initial states per parameter set")
+    parser.add_argument("--samples", type=int, default=0, help="draw this many random parameter sets instead of a grid")
+    parser.add_argument("--size", type=int, default=512)
+    parser.add_argument("--steps", type=int, default=2000, help="step budget per run")
+    parser.add_argument("--dtype", default="float64", choices=["float64", "float32"])
+    parser.add_argument("--storage", default="bool", choices=storages)
+    parser.add_argument("--tile-size", type=int, default=None, help="only recompute tiles near last step's changes")
+    parser.add_argument("--cycles", default="forward", choices=["forward", "stop", "off"],
+                        help="once the cells repeat, skip ahead to the outcome, stop, or keep stepping")
+    parser.add_argument("--snapshot", default=None, help="fork every run from this saved state")
+    parser.add_argument("--workers", type=int, default=os.cpu_count())
+    parser.add_argument("--seed", type=int, default=None, help="seed for --samples")
+    parser.add_argument("-o", "--out", default="-")
+    args = parser.parse_args(argv)
+
+    ranges = {key: parse_range(getattr(args, key)) for key in default_values}
+    kernels = args.kernels.split(",")
+    for kernel in kernels:
+        if kernel not in kernel_builders:
+            parser.error("unknown kernel %s" % kernel)
+    options = {"dtype": args.dtype, "storage": args.storage, "tile_size": args.tile_size}
+    runs = make_runs(ranges, kernels, args.seeds, args.samples, np.random.default_rng(args.seed))
+
+    out = sys.stdout if args.out == "-" else open(args.out, "w", newline="")
+    writer = csv.DictWriter(out, fieldnames=fields)
+    writer.writeheader()
+    won = 0
+    with ProcessPoolExecutor(args.workers) as pool:
+        futures = [pool.submit(run, params, args.size, args.steps, options, args.cycles, args.snapshot) for params in runs]
+        for future in as_completed(futures):
+            row = future.result()
+            won += row["won"]
+            writer.writerow(row)
+            out.flush()
+    print("%d of %d runs won" % (won, len(futures)), file=sys.stderr)
+    if out is not sys.stdout:
+        out.close()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,23 @@
+import numpy as np
+
+import convolution
+from engine import Engine, circle_kernel
+
+
+def test_spectra_only_for_fft_kernels():
+    convolution.analysis_cache.clear()
+    engine = Engine(256, 256, dtype=np.float32, storage="packed")
+    assert all(not kernel.spectra for kernel in engine.kernels.values())
+    engine.step(2)
+    for name, kernel in engine.kernels.items():
+        backends = set(kernel.backends.values())
+        assert bool(kernel.spectra) == ("fft" in backends), name
+        assert set(kernel.spectra) <= {np.dtype(np.complex64)}
+
+def test_fft_matches_direct():
+    cells = np.random.default_rng(0).random((64, 48)) > 0.5
+    kernel = circle_kernel(cells.shape, size=9)
+    stage = convolution.ConvolutionStage({"circle": kernel}, cells.shape)
+    stage.reset(cells)
+    assert np.allclose(stage.fft_convolve(kernel, np.empty(cells.shape)), convolution.direct_conv2d(cells, kernel))
+    assert list(kernel.spectra) == [np.dtype(np.complex128)]
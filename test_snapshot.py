@@ -0,0 +1,46 @@
+import numpy as np
+
+import snapshot
+import sweep
+from engine import Engine, default_values
+
+
+def test_forks_follow_their_own_values(tmp_path):
+    path = str(tmp_path / "warm.snap")
+    engine = Engine(64, 64, seed=1)
+    engine.step(20)
+    snapshot.save(path, engine)
+
+    first = dict(default_values)
+    second = dict(default_values, birthMin=0.4, popMax=0.7)
+    forks = [snapshot.load(path, values=values) for values in (first, second)]
+    for fork, values in zip(forks, (first, second)):
+        assert fork.values is values
+    assert second["birthMin"] == 0.4
+
+    trajectories = [[], []]
+    for _ in range(10):
+        for fork, trajectory in zip(forks, trajectories):
+            fork.step()
+            trajectory.append(fork.simulation_cells.copy())
+    assert any(not np.array_equal(a, b) for a, b in zip(*trajectories))
+
+def test_load_fills_missing_values(tmp_path):
+    path = str(tmp_path / "warm.snap")
+    engine = Engine(32, 32, seed=1, values=dict(default_values, deadMin=0.2))
+    snapshot.save(path, engine)
+    assert snapshot.load(path).values["deadMin"] == 0.2
+    assert snapshot.load(path, values={"popMax": 0.7}).values == dict(default_values, deadMin=0.2, popMax=0.7)
+
+def test_sweep_runs_differ_from_one_snapshot(tmp_path):
+    path = str(tmp_path / "warm.snap")
+    engine = Engine(64, 64, seed=1)
+    engine.step(20)
+    snapshot.save(path, engine)
+
+    rows = []
+    for birth_min in (0.6, 0.3):
+        params = dict(default_values, birthMin=birth_min, kernel="checkerboard", seed=0)
+        rows.append(sweep.run(params, 64, 30, {}, cycles="off", warm=path))
+    outcome = ("won", "stop", "steps", "derivative_metric", "gaussian_metric")
+    assert [rows[0][key] for key in outcome] != [rows[1][key] for key in outcome]
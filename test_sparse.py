@@ -0,0 +1,44 @@
+import numpy as np
+import pytest
+
+import convolution
+import sparse
+from engine import Engine, checkerboard_kernel, circle_kernel, gaussian_kernel
+
+
+@pytest.mark.parametrize("storage", ["bool", "float", "packed"])
+@pytest.mark.parametrize("kernel", ["checkerboard", "circle", "gaussian"])
+def test_tiles_match_full_grid(kernel, storage):
+    shape = (128, 128)
+    kernels = {"circle": circle_kernel(shape), "gaussian": gaussian_kernel(shape)}
+    engines = [Engine(128, 128, seed=2, storage=storage, rule_kernel=kernel, tile_size=tile_size,
+                      kernels=dict(kernels) if kernel != "checkerboard" else None)
+               for tile_size in (None, 16)]
+    for _ in range(80):
+        for engine in engines:
+            engine.step()
+        assert np.array_equal(engines[0].simulation_cells, engines[1].simulation_cells)
+
+@pytest.mark.parametrize("backend", convolution.exact_backends)
+@pytest.mark.parametrize("dtype", [np.float32, np.float64])
+def test_tile_density_matches_stage(backend, dtype):
+    shape = (96, 64)
+    cells = np.random.default_rng(1).random(shape) > 0.5
+    kernels = {"rule": checkerboard_kernel(shape) if backend == "box" else
+               gaussian_kernel(shape) if backend == "separable" else circle_kernel(shape)}
+    assert kernels["rule"].exact_backend(shape) == backend
+    stage = convolution.ConvolutionStage(kernels, shape, dtype, exact=True)
+    stage.reset(cells)
+    full = stage.convolve("rule") / dtype(np.sum(kernels["rule"].values))
+    ix, iy = np.nonzero(np.ones((6, 4), bool))
+    tiles = sparse.tile_density(cells, ix, iy, 16, kernels["rule"], backend, dtype)
+    assert np.array_equal(tiles, full.reshape(6, 16, 4, 16)[ix, :, iy, :])
+
+def test_box_matches_direct():
+    rng = np.random.default_rng(0)
+    cells = rng.random((3, 40, 48)) > 0.5
+    kernel = convolution.Kernel(np.kron([[1, 0.5], [0, 2]], np.ones((5, 5))), cells.shape[1:])
+    table = convolution.summed_area_table(cells, kernel.size)
+    box = convolution.box_conv2d(table, kernel.size, kernel, cells.shape[1:])
+    direct = convolution.direct_conv2d(cells, kernel)
+    assert np.allclose(box, direct)
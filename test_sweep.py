@@ -0,0 +1,35 @@
+import sweep
+from cycles import CycleDetector
+from engine import Engine, default_values
+
+
+def test_long_cycles_are_fast_forwarded(monkeypatch):
+    # Pretends the cells went round a 150 step cycle, longer than the
+    # metrics' default capacity
+    observe = CycleDetector.observe
+    def observe_long_cycle(self, packed, step, rule=None):
+        observe(self, packed, step, rule)
+        self.period = 150 if step >= 200 else None
+        return self.period
+    monkeypatch.setattr(CycleDetector, "observe", observe_long_cycle)
+    forwarded = []
+    fast_forward = Engine.fast_forward
+    def record_fast_forward(self, n):
+        forwarded.append(n)
+        return fast_forward(self, n)
+    monkeypatch.setattr(Engine, "fast_forward", record_fast_forward)
+
+    params = dict(default_values, kernel="checkerboard", seed=0)
+    row = sweep.run(params, 64, 2000, {})
+    assert forwarded
+    assert row["period"] == 150
+
+def test_fast_forward_needs_a_whole_period():
+    engine = Engine(32, 32, seed=0, metric_capacity=100, cycle_capacity=256)
+    engine.step(160)
+    engine.cycle_period = 150
+    assert "does not hold" in engine.fast_forward_blocker()
+    engine = Engine(32, 32, seed=0, metric_capacity=256, cycle_capacity=256)
+    engine.step(160)
+    engine.cycle_period = 150
+    assert engine.fast_forward_blocker() is None
@@ -0,0 +1,145 @@
+import multiprocessing as mp
+from multiprocessing import shared_memory
+
+import numpy as np
+from convolution import Kernel, ConvolutionStage, kernel_radius
+from engine import WinCondition, apply_rule, default_kernels, default_values, random_cells, win_limits
+from workspace import Workspace
+
+# Domain decomposed engine. The toroidal grid is cut into bands of rows, each
+# stepped by its own worker process. The cells live twice in shared memory
+# (current and next state); a worker reads its band plus a halo of rows from
+# its neighbours out of the current state, convolves the padded band locally
+# and writes its rows of the next state. Only per-band change counts travel
+# back to the parent, which keeps the metric histories and win condition.
+#
+# Convolving the padded band periodically is exact: the wrap-around only
+# pollutes halo rows, which are thrown away.
+
+value_keys = list(default_values)
+
+def tile_worker(index, rows, shape, halo, kernel_values, dtype, names, barrier):
+    blocks = [shared_memory.SharedMemory(name=name) for name in names]
+    buffers = values_array = counts = None
+    try:
+        width, height = shape
+        buffers = [np.ndarray(shape, bool, buffer=block.buf) for block in blocks[:2]]
+        values_array = np.ndarray(len(value_keys), float, buffer=blocks[2].buf)
+        counts = np.ndarray(blocks[3].size//8, np.int64, buffer=blocks[3].buf)
+        start, stop = rows
+        tile_shape = (stop-start+2*halo, height)
+        kernel = Kernel(kernel_values, tile_shape)
+        kernel_sum = float(np.sum(kernel.values))
+        workspace = Workspace()
+        convolution = ConvolutionStage({"rule": kernel}, tile_shape, dtype, workspace)
+        halo_rows = np.arange(start-halo, stop+halo) % width
+        padded = workspace.get("padded cells", tile_shape, bool)
+        density = workspace.get("density", tile_shape, convolution.dtype)
+        step = 0
+        while True:
+            barrier.wait()
+            if values_array[0] != values_array[0]:
+                # NaN values are the signal to shut down
+                break
+            current, following = buffers[step % 2], buffers[(step+1) % 2]
+            # Halo exchange, the rows above and below come from the neighbours
+            np.take(current, halo_rows, axis=0, out=padded)
+            convolution.reset(padded)
+            np.divide(convolution.convolve("rule"), kernel_sum, out=density)
+            new_cells = apply_rule(density, padded, dict(zip(value_keys, values_array)), workspace)
+            band = new_cells[halo:halo+stop-start]
+            counts[index] = np.count_nonzero(band != current[start:stop])
+            following[start:stop] = band
+            step += 1
+            barrier.wait()
+    except BaseException:
+        barrier.abort()
+        raise
+    finally:
+        del buffers, values_array, counts
+        for block in blocks:
+            block.close()
+
+
+class TiledEngine(WinCondition):
+    def __init__(self, width, height, values=None, kernels=None, rule_kernel="checkerboard", cells=None, seed=None, win_limits=win_limits,
+                 tiles=None, dtype=float, metric_capacity=None, metric_specs=None):
+        self.width = width
+        self.height = height
+        self.win_limits = win_limits
+        self.values = values if values is not None else dict(default_values)
+        self.kernels = kernels if kernels is not None else default_kernels((width, height))
+        self.rule_kernel = rule_kernel
+        tiles = min(tiles or mp.cpu_count(), width)
+        # Halos cover the widest kernel, so any of them could drive the rule
+        self.halo = max(kernel_radius(kernel) for kernel in self.kernels.values())
+
+        self.rng = np.random.default_rng(seed)
+        if cells is None:
+            cells = random_cells(width, height, self.rng)
+
+        cells_size = width*height
+        self.blocks = [shared_memory.SharedMemory(create=True, size=size)
+                       for size in (cells_size, cells_size, 8*len(value_keys), 8*tiles)]
+        self.buffers = [np.ndarray((width, height), bool, buffer=block.buf) for block in self.blocks[:2]]
+        self.values_array = np.ndarray(len(value_keys), float, buffer=self.blocks[2].buf)
+        self.counts = np.ndarray(tiles, np.int64, buffer=self.blocks[3].buf)
+        self.buffers[0][...] = np.asarray(cells) > 0.5
+
+        bounds = np.linspace(0, width, tiles+1).astype(int)
+        names = [block.name for block in self.blocks]
+        self.barrier = mp.Barrier(tiles+1)
+        self.workers = []
+        for index in range(tiles):
+            rows = (int(bounds[index]), int(bounds[index+1]))
+            worker = mp.Process(target=tile_worker, daemon=True,
+                                args=(index, rows, (width, height), self.halo, self.kernels[rule_kernel].values, dtype, names, self.barrier))
+            worker.start()
+            self.workers.append(worker)
+
+        self.reset_metrics(metric_capacity, metric_specs)
+        self.steps = 0
+
+    @property
+    def simulation_cells(self):
+        return self.buffers[self.steps % 2]
+
+    def paint(self, x, y, value):
+        self.simulation_cells[x, y] = value
+
+    def step(self, n=1):
+        for _ in range(n):
+            self.step_once()
+        return self
+
+    def step_once(self):
+        self.values_array[:] = [self.values[key] for key in value_keys]
+        self.barrier.wait()
+        self.barrier.wait()
+        # The metrics only need the number of changed cells, see metrics.py
+        due = self.metrics_due()
+        self.steps += 1
+        self.record_metrics(int(self.counts.sum()), due)
+
+    def close(self):
+        if not self.workers:
+            return
+        self.values_array[0] = np.nan
+        try:
+            self.barrier.wait()
+        except Exception:
+            pass
+        for worker in self.workers:
+            worker.join()
+        self.workers = []
+        # The views have to go before the shared memory can be closed
+        self.buffers = self.values_array = self.counts = None
+        for block in self.blocks:
+            block.close()
+            block.unlink()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
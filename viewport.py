@@ -0,0 +1,103 @@
+import numpy as np
+
+# Shows any part of a large grid at any zoom in a fixed size display, so
+# only the display's worth of pixels is converted and uploaded per frame.
+#
+# zoom is display pixels per grid cell and (x, y) the grid position at the
+# display's corner; the grid is a torus and the view wraps around its edges.
+# Zoomed in, cells are repeated. Zoomed out, the display samples a level of
+# a min/max/mean pyramid of the frame that is at least as coarse as the
+# display, so with "max" no live cell disappears from view, however far out.
+
+reductions = {"max": np.maximum, "min": np.minimum, "mean": np.add}
+
+class Pyramid:
+    # Level k reduces 2^k x 2^k blocks of the frame. Levels are built when
+    # first asked for and kept until the frame's key (e.g. its step) changes.
+    def __init__(self, reduce="max"):
+        if reduce not in reductions:
+            raise ValueError("reduce must be one of %s" % (tuple(reductions),))
+        self.reduce = reduce
+        self.key = None
+        self.levels = []
+
+    def level(self, frame, key, n):
+        # Level n, or the coarsest there is, and its number
+        if key != self.key or not self.levels or self.levels[0] is not frame:
+            self.key = key
+            self.levels = [frame]
+        while len(self.levels) <= n:
+            previous = self.levels[-1]
+            width, height = previous.shape
+            if width < 2 or height < 2:
+                break
+            # Odd last rows and columns are dropped
+            previous = previous[:width//2*2, :height//2*2]
+            if self.reduce == "mean" and previous.dtype.kind != "f":
+                previous = previous.astype(np.float32)
+            combine = reductions[self.reduce]
+            level = combine(combine(previous[0::2, 0::2], previous[1::2, 0::2]),
+                            combine(previous[0::2, 1::2], previous[1::2, 1::2]))
+            if self.reduce == "mean":
+                level *= 0.25
+            self.levels.append(level)
+        n = min(n, len(self.levels)-1)
+        return n, self.levels[n]
+
+
+class Viewport:
+    max_zoom = 64
+
+    def __init__(self, grid_shape, display_shape, reduce="max"):
+        self.grid_shape = tuple(grid_shape)
+        self.display_shape = tuple(display_shape)
+        self.pyramid = Pyramid(reduce)
+        self.fit()
+
+    @property
+    def min_zoom(self):
+        # The whole grid fits
+        return min(d/g for d, g in zip(self.display_shape, self.grid_shape))
+
+    def fit(self):
+        self.zoom = self.min_zoom
+        self.x = 0.0
+        self.y = 0.0
+
+    def pan(self, dx, dy):
+        # Moves the content by (dx, dy) display pixels
+        width, height = self.grid_shape
+        self.x = (self.x - dx/self.zoom) % width
+        self.y = (self.y - dy/self.zoom) % height
+
+    def zoom_at(self, factor, px, py):
+        # Zooms by factor, keeping the cell under display pixel (px, py) there
+        zoom = min(max(self.zoom*factor, self.min_zoom), self.max_zoom)
+        gx = self.x + px/self.zoom
+        gy = self.y + py/self.zoom
+        self.zoom = zoom
+        self.x = (gx - px/zoom) % self.grid_shape[0]
+        self.y = (gy - py/zoom) % self.grid_shape[1]
+
+    def to_grid(self, px, py):
+        # The grid cell under display pixel (px, py)
+        width, height = self.grid_shape
+        return int(np.floor(self.x + px/self.zoom)) % width, int(np.floor(self.y + py/self.zoom)) % height
+
+    def render(self, frame, key=None):
+        # The display's view of frame, a grid sized array. key tells frames
+        # apart for the pyramid cache; without one it is rebuilt every call.
+        if self.zoom == 1 and self.x == 0 and self.y == 0 and frame.shape == self.display_shape:
+            return frame
+        if key is None:
+            key = object()
+        level = 0
+        if self.zoom < 1:
+            level = int(np.ceil(np.log2(1/self.zoom) - 1e-9))
+        level, source = self.pyramid.level(frame, key, level)
+        # Display pixel centres in the level's cells
+        scale = 2**level
+        width, height = self.display_shape
+        rows = np.floor((self.x + (np.arange(width)+0.5)/self.zoom) / scale).astype(int) % source.shape[0]
+        columns = np.floor((self.y + (np.arange(height)+0.5)/self.zoom) / scale).astype(int) % source.shape[1]
+        return source[rows[:, None], columns[None, :]]
@@ -0,0 +1,23 @@
+import numpy as np
+
+class Workspace:
+    # Owns the full-grid buffers of a step. Each named buffer is allocated on
+    # first use and then reused for as long as its shape and dtype stay the
+    # same, so steady stepping allocates nothing and peak memory stays flat.
+    def __init__(self):
+        self.buffers = {}
+
+    def get(self, name, shape, dtype):
+        buffer = self.buffers.get(name)
+        if buffer is None or buffer.shape != tuple(shape) or buffer.dtype != dtype:
+            buffer = self.buffers[name] = np.empty(shape, dtype)
+        return buffer
+
+    def swap(self, name, other):
+        # Exchanges two buffers, e.g. the next state with the current one
+        self.buffers[name], self.buffers[other] = self.buffers[other], self.buffers[name]
+        return self.buffers[name]
+
+    @property
+    def nbytes(self):
+        return sum(buffer.nbytes for buffer in self.buffers.values())